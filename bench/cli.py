@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+# -*- coding: utf-8 -*-
+"""CLI commands benchmark for fbxosctrl, against a local mock Freebox Server.
+
+Runs fbxosctrl commands in fresh interpreters against bench/mock_freebox.py
+over HTTPS, and reports for each command (median of the runs):
+ - wall time of the process
+ - round trips: HTTP requests received by the server
+ - bytes sent and received by fbxosctrl, HTTP headers included
+ - peak memory: max resident set size of the process
+The session opened by a first run is reused by the next ones, as between
+real invocations, unless --login is given.
+
+Results can be saved, then compared to in later runs: the run fails when a
+command got slower or bigger than tolerance, or exchanges more requests or
+bytes than in the baseline.
+
+Usage: python3 bench/cli.py [--runs N] [--latency MS] [--items N] [--format FORMAT] [--login]
+                            [--save FILE] [--baseline FILE] [--tolerance PCT] [COMMAND ...]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_freebox import CA_FILE, MockFreebox
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# benchmarked command => fbxosctrl arguments
+COMMANDS = {
+    'sinfo': ['--sinfo'],
+    'einfo': ['--einfo'],
+    'linfo': ['--linfo'],
+    'dspace': ['--dspace'],
+    'dlist': ['--dlist'],
+    'wrstatus': ['--wrstatus'],
+    'dhcpleases': ['--dhcpleases'],
+    'lease-find': ['--lease-find', '192.168.0.1'],
+    'pfwd': ['--pfwd'],
+    'clist': ['--clist'],
+    'cnew': ['--cnew'],
+    'tlist': ['--tlist'],
+    'all': ['--sinfo', '--einfo', '--linfo', '--dspace', '--wrstatus', '--dhcpleases', '--pfwd', '--clist', '--tlist'],
+}
+
+# output format => fbxosctrl arguments
+FORMATS = {'text': [], 'json': ['-j'], 'ndjson': ['--ndjson'], 'csv': ['--csv']}
+
+# reported metrics: (name, header, format)
+METRICS = (
+    ('wall_ms', 'wall ms', '{:9.1f}'),
+    ('round_trips', 'round trips', '{:11d}'),
+    ('bytes_sent', 'sent B', '{:9d}'),
+    ('bytes_received', 'received B', '{:10d}'),
+    ('peak_mb', 'peak MB', '{:8.1f}'),
+)
+
+
+def run_command(mock, conf_path, args):
+    """Run fbxosctrl with args, return its metrics"""
+    mock.reset_stats()
+    env = dict(os.environ, FBXOSCTRL_CA_FILE=CA_FILE)
+    with tempfile.TemporaryFile() as err:
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            [sys.executable, os.path.join(REPO_DIR, 'fbxosctrl.py'), '-c', conf_path] + args,
+            stdout=subprocess.DEVNULL, stderr=err, env=env)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        err.seek(0)
+        errors = err.read().decode(errors='replace')
+    # actions exit with 1 when they succeed with a True result
+    if proc.returncode not in (0, 1) or 'Traceback' in errors:
+        raise RuntimeError('fbxosctrl {} failed ({}):\n{}'.format(' '.join(args), proc.returncode, errors))
+
+    stats = mock.stats
+    # ru_maxrss is in KB, but in bytes on macOS
+    peak = rusage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return {
+        'wall_ms': wall * 1000, 'round_trips': stats['requests'],
+        'bytes_sent': stats['bytes_in'], 'bytes_received': stats['bytes_out'], 'peak_mb': peak}
+
+
+def bench_command(mock, conf_path, args, runs, login):
+    """Return the median metrics of runs of fbxosctrl with args"""
+    samples = []
+    for _ in range(runs):
+        if login:
+            session_file = os.path.join(conf_path, 'fbxosctrl_session.txt')
+            if os.path.exists(session_file):
+                os.remove(session_file)
+        samples.append(run_command(mock, conf_path, args))
+    return {name: type(samples[0][name])(statistics.median(s[name] for s in samples)) for name, _, _ in METRICS}
+
+
+def regressions(result, base, tolerance):
+    """Return the names of the metrics of result worse than base ones"""
+    worse = []
+    for name, _, _ in METRICS:
+        if name not in base:
+            continue
+        # time and memory vary between runs, exchanges must not grow
+        limit = base[name] * (1 + tolerance / 100) if name in ('wall_ms', 'peak_mb') else base[name]
+        if result[name] > limit:
+            worse.append(name)
+    return worse
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fbxosctrl CLI commands benchmark against a mock Freebox Server')
+    parser.add_argument(
+        'commands', nargs='*', metavar='COMMAND',
+        help='commands to run, among: {} (default: all of them)'.format(', '.join(COMMANDS)))
+    parser.add_argument('--runs', type=int, default=5, help='number of runs per command (median is kept)')
+    parser.add_argument('--latency', type=float, default=0.0, help='delay of each server reply in ms')
+    parser.add_argument('--items', type=int, default=100, help='number of entries of lists (leases, calls...)')
+    parser.add_argument('--format', choices=list(FORMATS), default='text', help='fbxosctrl output format')
+    parser.add_argument('--login', action='store_true', help='open a new session for each run')
+    parser.add_argument('--save', metavar='FILE', help='save results to FILE, in JSON format')
+    parser.add_argument('--baseline', metavar='FILE', help='compare results to the ones saved in FILE')
+    parser.add_argument('--tolerance', type=float, default=20.0, help='time and memory tolerance in %% over baseline')
+    args = parser.parse_args()
+
+    unknown = [cmd for cmd in args.commands if cmd not in COMMANDS]
+    if unknown:
+        parser.error('unknown commands: {}'.format(', '.join(unknown)))
+    commands = args.commands or list(COMMANDS)
+    params = {'latency': args.latency, 'items': args.items, 'format': args.format, 'login': args.login}
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as infile:
+            saved = json.load(infile)
+        if saved.get('params') != params:
+            print('Warning: baseline parameters differ: {}'.format(saved.get('params')))
+        baseline = saved.get('results', {})
+
+    print('latency: {:g} ms, items: {}, format: {}, runs: {}, {}'.format(
+        args.latency, args.items, args.format, args.runs, 'new session per run' if args.login else 'cached session'))
+    print('{:12} {}'.format('command', ' '.join(header for _, header, _ in METRICS)))
+
+    results = {}
+    failed = []
+    with MockFreebox(latency=args.latency / 1000, items=args.items) as mock, \
+            tempfile.TemporaryDirectory() as conf_path:
+        mock.write_conf(conf_path)
+        # first run opens the session reused by next ones
+        run_command(mock, conf_path, ['--sinfo'])
+        for cmd in commands:
+            result = bench_command(mock, conf_path, FORMATS[args.format] + COMMANDS[cmd], args.runs, args.login)
+            results[cmd] = result
+            line = '{:12} {}'.format(cmd, ' '.join(fmt.format(result[name]) for name, _, fmt in METRICS))
+            if cmd in baseline:
+                worse = regressions(result, baseline[cmd], args.tolerance)
+                if worse:
+                    failed.append(cmd)
+                    line += '  REGRESSION: ' + ', '.join(
+                        '{} {:g} -> {:g}'.format(name, baseline[cmd][name], result[name]) for name in worse)
+            print(line)
+
+    if args.save:
+        with open(args.save, 'w') as outfile:
+            json.dump({'params': params, 'results': results}, outfile, indent=1, sort_keys=True)
+
+    if args.baseline:
+        print('FAILED: {}'.format(', '.join(failed)) if failed else 'OK')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# -*- coding: utf-8 -*-
+"""Response decoding micro-benchmark for fbxosctrl.
+
+Compares, on large payloads shaped like FreeboxOS replies (call log, downloads,
+DHCP leases), the time needed to turn a received HTTP response into a
+FbxResponse:
+ - text: the body decoded by requests (r.text, charset detection included when
+   the reply has no charset) then parsed with json.loads, as done before
+ - bytes: the body parsed directly from r.content, with each installed JSON
+   backend (json, orjson, ujson)
+
+Usage: python3 bench/json_decode.py [--runs N] [--items N]
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fbxosctrl  # noqa: E402
+from mock_freebox import encode_reply, make_payloads as make_results  # noqa: E402
+
+
+def make_payloads(items):
+    """Return {name: body} of FreeboxOS-like responses with items entries each"""
+    results = make_results(items)
+    return {uri: encode_reply(results[uri]) for uri in ('/call/log/', '/downloads/', '/dhcp/dynamic_lease/')}
+
+
+def make_response(body, charset):
+    """Build a requests response as received from the Freebox Server"""
+    import requests
+    r = requests.models.Response()
+    r.status_code = 200
+    r._content = body
+    r.encoding = charset
+    return r
+
+
+def decode_text(r):
+    """Previous decoding: body text built for the log line and for parsing"""
+    '{} response: {}'.format('GET', r.text)
+    return fbxosctrl.FbxResponse(json.loads(r.text))
+
+
+def make_decode_bytes(loads):
+    """Current decoding, with the given JSON backend"""
+    def decode_bytes(r):
+        return fbxosctrl.FbxResponse(loads(r.content))
+    return decode_bytes
+
+
+def json_backends():
+    """Return {name: loads} of the installed JSON backends"""
+    backends = {'json': json.loads}
+    for name in ('orjson', 'ujson'):
+        try:
+            backends[name] = __import__(name).loads
+        except ImportError:
+            pass
+    return backends
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fbxosctrl response decoding micro-benchmark')
+    parser.add_argument('--runs', type=int, default=5, help='number of runs (best one is kept)')
+    parser.add_argument('--items', type=int, default=20000, help='number of entries per payload')
+    args = parser.parse_args()
+
+    decoders = [('text, no charset', None, decode_text), ('text, utf-8', 'utf-8', decode_text)]
+    decoders += [('bytes, ' + name, None, make_decode_bytes(loads)) for name, loads in json_backends().items()]
+
+    for uri, body in make_payloads(args.items).items():
+        print('{} ({} entries, {:.1f} MB)'.format(uri, args.items, len(body) / 1e6))
+        reference = None
+        for label, charset, decode in decoders:
+            r = make_response(body, charset)
+            assert decode(r).result == json.loads(body)['result']
+            elapsed = min(timeit.repeat(lambda: decode(r), number=1, repeat=args.runs)) * 1000
+            if reference is None:
+                reference = elapsed
+            print('  {:20} {:9.2f} ms  x{:.1f}'.format(label, elapsed, reference / elapsed))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+
+# -*- coding: utf-8 -*-
+"""Mock Freebox Server for fbxosctrl benchmarks.
+
+Local stand-in for a Freebox Server, serving over HTTPS the endpoints used by
+fbxosctrl commands:
+ - login: /login and /login/session/, the session password being checked
+   against APP_TOKEN as FreeboxOS does
+ - /system, /connection, /connection/xdsl, /connection/ftth, /storage/disk/,
+   /wifi/config/ (GET and PUT)
+ - lists: /dhcp/dynamic_lease/, /fw/redir/, /call/log/, /downloads/
+Its certificate (certs/server.pem, for localhost and 127.0.0.1) is issued by
+a test CA (certs/ca.pem), which fbxosctrl trusts with --ca-file or the
+FBXOSCTRL_CA_FILE environment variable.
+
+Each reply is delayed by a given latency, and lists have a given number of
+entries. Connections, requests and bytes exchanged are counted.
+
+Usage: python3 bench/mock_freebox.py [--port N] [--latency MS] [--items N] [--media xdsl|ftth] [--conf DIR]
+
+With --conf, a configuration directory is set up for fbxosctrl to reach the
+server, e.g.:
+    python3 fbxosctrl.py -c DIR --ca-file bench/certs/ca.pem --sinfo
+
+Certificates were generated by:
+    openssl req -x509 -newkey ec -pkeyopt ec_paramgen_curve:prime256v1 -nodes \\
+        -keyout ca.key -out ca.pem -days 36500 -subj "/O=fbxosctrl/CN=fbxosctrl test CA" \\
+        -addext "basicConstraints=critical,CA:TRUE" -addext "keyUsage=critical,keyCertSign,cRLSign"
+    openssl req -newkey ec -pkeyopt ec_paramgen_curve:prime256v1 -nodes \\
+        -keyout server.key -out server.csr -subj "/O=fbxosctrl/CN=localhost"
+    openssl x509 -req -in server.csr -CA ca.pem -CAkey ca.key -set_serial 2 -out server.pem \\
+        -days 36500 -extfile ext.cnf
+ext.cnf holding subjectAltName=DNS:localhost,IP:127.0.0.1, basicConstraints=CA:FALSE,
+keyUsage=critical,digitalSignature, extendedKeyUsage=serverAuth,
+subjectKeyIdentifier=hash and authorityKeyIdentifier=keyid lines.
+"""
+
+import argparse
+import hmac
+import json
+import os
+import ssl
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+CERTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'certs')
+CA_FILE = os.path.join(CERTS_DIR, 'ca.pem')
+
+API_BASE_URL = '/api/'
+API_VERSION = '8.0'
+API_PREFIX = API_BASE_URL + 'v' + API_VERSION[:1]
+
+APP_ID = 'fr.freebox.fbxosctrl'
+APP_TOKEN = 'mock-app-token'
+TRACK_ID = 1
+CHALLENGE = 'mock-challenge'
+SESSION_TOKEN = 'mock-session-token'
+
+
+def make_payloads(items, media='xdsl'):
+    """Return {uri: result} of FreeboxOS-like replies, lists having items entries each"""
+    system = {
+        'model_info': {'pretty_name': 'Freebox Server (r2)', 'name': 'fbxgw-r2/full'},
+        'mac': '68:A3:78:01:02:03', 'serial': '7626000000000000', 'firmware_version': '4.7.4',
+        'board_name': 'fbxgw2r', 'uptime': '9 jours 51 minutes 56 secondes', 'uptime_val': 856316,
+        'disk_status': 'active', 'user_main_storage': 'Disque dur', 'box_authenticated': True,
+        'sensors': [
+            {'id': 'temp_hdd0', 'name': 'Disque dur', 'value': 37},
+            {'id': 'temp_sw', 'name': 'Température Switch', 'value': 53},
+            {'id': 'temp_cpum', 'name': 'Température CPU M', 'value': 63},
+            {'id': 'temp_cpub', 'name': 'Température CPU B', 'value': 58}],
+        'fans': [{'id': 'fan0_speed', 'name': 'Ventilateur 1', 'value': 2570}]}
+    connection = {
+        'type': 'ethernet', 'media': media, 'state': 'up', 'ipv4': '82.64.0.1', 'ipv6': '2a01:e0a::1',
+        'bandwidth_down': 1000000000 if media == 'ftth' else 20000000, 'rate_down': 1234567,
+        'bandwidth_up': 700000000 if media == 'ftth' else 1000000, 'rate_up': 56789,
+        'bytes_down': 123456789012, 'bytes_up': 12345678901}
+    xdsl = {
+        'status': {'status': 'showtime', 'protocol': 'adsl2plus_a', 'modulation': 'adsl', 'uptime': 856000},
+        'down': {'rate': 20000, 'maxrate': 22000, 'attn_10': 300, 'snr_10': 60, 'crc': 0, 'fec': 12},
+        'up': {'rate': 1000, 'maxrate': 1100, 'attn_10': 150, 'snr_10': 70, 'crc': 0, 'fec': 0}}
+    ftth = {
+        'has_sfp': True, 'sfp_present': True, 'sfp_model': 'F-MDCONU3A', 'sfp_vendor': 'FREEBOX',
+        'sfp_serial': 'SN0001', 'sfp_has_signal': True, 'sfp_alim_ok': True, 'link': True,
+        'sfp_has_power_report': True, 'sfp_pwr_tx': 245, 'sfp_pwr_rx': -1820}
+    disks = [{
+        'id': 0, 'type': 'internal', 'model': 'ST1000LM024', 'serial': 'S2ZJ00000', 'temp': 37,
+        'spinning': True, 'state': 'enabled', 'total_bytes': 1000204886016,
+        'partitions': [{
+            'id': 1, 'label': 'Disque dur', 'fstype': 'ext4', 'state': 'mounted',
+            'total_bytes': 983349346304, 'used_bytes': 432118231040, 'free_bytes': 551231115264}]}]
+    wifi = {'enabled': True, 'mac_filter_state': 'disabled'}
+    leases = [{
+        'mac': '00:24:D4:{:02X}:{:02X}:{:02X}'.format(i >> 16 & 255, i >> 8 & 255, i & 255),
+        'ip': '192.168.{}.{}'.format(i >> 8 & 255, i & 255), 'hostname': 'pc-séjour-{}'.format(i),
+        'is_static': i % 10 == 0, 'lease_remaining': 40000, 'assign_time': 1600000000,
+        'refresh_time': 1600000000, 'host': {
+            'reachable': i % 2 == 0, 'last_activity': 1600000000, 'primary_name': 'PC {}'.format(i),
+            'vendor_name': 'Freebox SAS', 'host_type': 'workstation'}} for i in range(items)]
+    redirs = [{
+        'id': i, 'enabled': i % 3 != 0, 'hostname': 'pc-séjour-{}'.format(i), 'comment': 'service {}'.format(i),
+        'lan_port': 8000 + i % 1000, 'wan_port_start': 10000 + i, 'wan_port_end': 10000 + i,
+        'src_ip': '0.0.0.0', 'lan_ip': '192.168.{}.{}'.format(i >> 8 & 255, i & 255),
+        'ip_proto': ('tcp', 'udp')[i % 2]} for i in range(items)]
+    # calls are listed most recent first
+    calls = [{
+        'id': i, 'type': ('missed', 'accepted', 'outgoing')[i % 3], 'datetime': 1600000000 + i * 60,
+        'number': '06{:08d}'.format(i), 'name': 'Frédéric Gérard {}'.format(i), 'duration': i % 600,
+        'new': i % 7 == 0, 'contact_id': i % 50, 'src_id': 0, 'line_id': 0} for i in reversed(range(items))]
+    downloads = [{
+        'id': i, 'type': ('bt', 'http', 'ftp', 'nzb')[i % 4], 'name': 'Vidéo été {}.mkv'.format(i),
+        'status': ('downloading', 'done', 'stopped', 'seeding')[i % 4], 'size': 700000000 + i,
+        'rx_bytes': 350000000, 'tx_bytes': 1000 * i, 'rx_rate': 120000, 'tx_rate': 2000, 'eta': 3000,
+        'download_dir': 'L0Rpc3F1ZSBkdXIvVMOpbMOpY2hhcmdlbWVudHMv', 'queue_pos': i,
+        'io_priority': 'normal', 'created_ts': 1600000000 + i} for i in range(items)]
+    return {
+        '/system': system, '/connection': connection, '/connection/xdsl': xdsl, '/connection/ftth': ftth,
+        '/storage/disk/': disks, '/wifi/config/': wifi, '/dhcp/dynamic_lease/': leases,
+        '/fw/redir/': redirs, '/call/log/': calls, '/downloads/': downloads}
+
+
+def encode_reply(result):
+    """Return the body of a successful FreeboxOS reply"""
+    return json.dumps({'success': True, 'result': result}, ensure_ascii=False).encode('utf-8')
+
+
+class CountingStream:
+    """File object proxy counting the bytes read or written through it"""
+
+    def __init__(self, stream, count):
+        """Constructor, count being called with the number of bytes of each read/write"""
+        self._stream = stream
+        self._count = count
+
+    def read(self, *args):
+        data = self._stream.read(*args)
+        self._count(len(data))
+        return data
+
+    def readline(self, *args):
+        data = self._stream.readline(*args)
+        self._count(len(data))
+        return data
+
+    def write(self, data):
+        self._count(len(data))
+        return self._stream.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class MockFreeboxHandler(BaseHTTPRequestHandler):
+    """FreeboxOS API request handler"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        mock = self.server.mock
+        mock.count('connections')
+        self.rfile = CountingStream(self.rfile, lambda n: mock.count('bytes_in', n))
+        self.wfile = CountingStream(self.wfile, lambda n: mock.count('bytes_out', n))
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.mock.handle(self, 'GET')
+
+    def do_POST(self):
+        self.server.mock.handle(self, 'POST')
+
+    def do_PUT(self):
+        self.server.mock.handle(self, 'PUT')
+
+    def send_json(self, content, status=200):
+        """Send a JSON reply"""
+        body = content if isinstance(content, bytes) else json.dumps(content, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MockFreebox:
+    """Mock Freebox Server, run in a background thread"""
+
+    def __init__(self, port=0, latency=0.0, items=100, media='xdsl', tls=True):
+        """Constructor, latency being in seconds, port 0 picking a free one"""
+        self._latency = latency
+        self._tls = tls
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.reset_stats()
+        # replies are encoded once, so that they cost the same for each request
+        self._payloads = make_payloads(items, media)
+        self._bodies = {uri: encode_reply(result) for uri, result in self._payloads.items()}
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), MockFreeboxHandler)
+        self._server.mock = self
+        if tls:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(os.path.join(CERTS_DIR, 'server.pem'), os.path.join(CERTS_DIR, 'server.key'))
+            self._server.socket = context.wrap_socket(self._server.socket, server_side=True)
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def stats(self):
+        """Return the number of connections, requests, logins and bytes exchanged so far"""
+        with self._lock:
+            return dict(self._stats)
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {'connections': 0, 'requests': 0, 'logins': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._stats[name] += value
+
+    def start(self):
+        """Serve requests in a background thread"""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def write_conf(self, conf_path):
+        """Set up a fbxosctrl configuration directory registered to this server"""
+        addressing = {
+            'protocol': 'https' if self._tls else 'http', 'api_domain': 'localhost', 'port': self.port,
+            'api_base_url': API_BASE_URL, 'api_version': API_VERSION}
+        with open(os.path.join(conf_path, 'fbxosctrl_addressing.txt'), 'w') as outfile:
+            json.dump(addressing, outfile, indent=True, sort_keys=True)
+        with open(os.path.join(conf_path, 'fbxosctrl_registration.txt'), 'w') as outfile:
+            json.dump({'app_token': APP_TOKEN, 'track_id': TRACK_ID}, outfile, indent=True, sort_keys=True)
+
+    def handle(self, handler, method):
+        """Reply to a request"""
+        self.count('requests')
+        length = int(handler.headers.get('Content-Length') or 0)
+        data = handler.rfile.read(length) if length else b''
+        if self._latency:
+            time.sleep(self._latency)
+
+        path = handler.path.split('?')[0]
+        if not path.startswith(API_PREFIX):
+            return handler.send_json(
+                {'success': False, 'msg': 'Invalid API version', 'error_code': 'invalid_api_version'}, 400)
+        uri = path[len(API_PREFIX):]
+
+        if uri in ('/login', '/login/') and method == 'GET':
+            return handler.send_json({'success': True, 'result': {'logged_in': False, 'challenge': CHALLENGE}})
+        if uri == '/login/session/' and method == 'POST':
+            return self._open_session(handler, data)
+
+        if handler.headers.get('X-Fbx-App-Auth') != SESSION_TOKEN:
+            return handler.send_json(
+                {'success': False, 'msg': 'Authentication required', 'error_code': 'auth_required'}, 403)
+        if uri not in self._bodies:
+            return handler.send_json({'success': False, 'msg': 'Invalid request', 'error_code': 'invalid_request'}, 404)
+        if method == 'PUT' and uri == '/wifi/config/':
+            with self._lock:
+                self._payloads[uri].update(json.loads(data.decode('utf-8')))
+                self._bodies[uri] = encode_reply(self._payloads[uri])
+        elif method != 'GET':
+            return handler.send_json({'success': False, 'msg': 'Invalid request', 'error_code': 'invalid_request'}, 405)
+        return handler.send_json(self._bodies[uri])
+
+    def _open_session(self, handler, data):
+        """Open a session if the password is the challenge signed with APP_TOKEN"""
+        try:
+            request = json.loads(data.decode('utf-8'))
+        except ValueError:
+            request = {}
+        password = hmac.new(APP_TOKEN.encode(), CHALLENGE.encode(), 'sha1').hexdigest()
+        if request.get('app_id') != APP_ID or request.get('password') != password:
+            return handler.send_json({'success': False, 'msg': 'Invalid password', 'error_code': 'invalid_token'}, 403)
+        self.count('logins')
+        return handler.send_json({'success': True, 'result': {
+            'session_token': SESSION_TOKEN, 'challenge': CHALLENGE,
+            'permissions': {'settings': True, 'contacts': True, 'calls': True, 'explorer': True,
+                            'downloader': True, 'parental': True, 'pvr': True}}})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='mock Freebox Server for fbxosctrl benchmarks')
+    parser.add_argument('--port', type=int, default=4443, help='port to listen on, 127.0.0.1 only')
+    parser.add_argument('--latency', type=float, default=0.0, help='delay of each reply in ms')
+    parser.add_argument('--items', type=int, default=100, help='number of entries of lists')
+    parser.add_argument('--media', choices=('xdsl', 'ftth'), default='xdsl', help='connection media')
+    parser.add_argument('--http', action='store_true', help='serve plain HTTP instead of HTTPS')
+    parser.add_argument('--conf', metavar='DIR', help='set up a fbxosctrl configuration directory')
+    args = parser.parse_args()
+
+    mock = MockFreebox(args.port, args.latency / 1000, args.items, args.media, tls=not args.http)
+    if args.conf:
+        mock.write_conf(args.conf)
+    print('Serving on {}://localhost:{}{} (CA file: {})'.format(
+        'http' if args.http else 'https', mock.port, API_PREFIX, CA_FILE))
+    mock.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    print('Stats: {}'.format(mock.stats))
+    mock.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# -*- coding: utf-8 -*-
+"""Startup budget benchmark for fbxosctrl.
+
+Measures, in fresh interpreters:
+ - the import time of fbxosctrl module, as reported by 'python -X importtime'
+ - the time needed to reach command dispatch (controller + cli built, args parsed)
+and fails if one of them exceeds its budget.
+
+Usage: python3 bench/startup.py [--runs N] [--import-budget MS] [--dispatch-budget MS]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# code run in child interpreter to measure the time to reach dispatch
+DISPATCH_PROBE = """
+import sys, time
+t0 = time.perf_counter()
+import fbxosctrl
+ctrl = fbxosctrl.FreeboxOSCtrl()
+cli = fbxosctrl.FreeboxOSCli(ctrl)
+args = cli.parse_args(['-c', sys.argv[1], '--wrstatus'])
+handler = cli._handler('wrstatus')
+t1 = time.perf_counter()
+heavy = [m for m in ('requests', 'zeroconf', 'urllib3') if m in sys.modules]
+print('{:.3f} {}'.format((t1 - t0) * 1000, ','.join(heavy)))
+"""
+
+
+def measure_import(python):
+    """Return fbxosctrl cumulative import time in ms"""
+    r = subprocess.run(
+        [python, '-X', 'importtime', '-c', 'import fbxosctrl'],
+        cwd=REPO_DIR, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+        universal_newlines=True, check=True)
+    for line in r.stderr.splitlines():
+        fields = [f.strip() for f in line.split('|')]
+        if len(fields) == 3 and fields[2] == 'fbxosctrl':
+            return int(fields[1]) / 1000
+    raise RuntimeError('fbxosctrl not found in importtime output')
+
+
+def measure_dispatch(python, conf_path):
+    """Return time to dispatch in ms and list of heavy modules loaded"""
+    r = subprocess.run(
+        [python, '-c', DISPATCH_PROBE, conf_path],
+        cwd=REPO_DIR, stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    elapsed, _, heavy = r.stdout.strip().partition(' ')
+    return float(elapsed), [m for m in heavy.split(',') if m]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fbxosctrl startup budget benchmark')
+    parser.add_argument('--runs', type=int, default=10, help='number of runs (best one is kept)')
+    parser.add_argument('--import-budget', type=float, default=30.0, help='import budget in ms')
+    parser.add_argument('--dispatch-budget', type=float, default=40.0, help='import+dispatch budget in ms')
+    args = parser.parse_args()
+
+    python = sys.executable
+    # first run compiles and caches bytecode
+    measure_import(python)
+
+    with tempfile.TemporaryDirectory() as conf_path:
+        import_ms = min(measure_import(python) for _ in range(args.runs))
+        dispatch = [measure_dispatch(python, conf_path) for _ in range(args.runs)]
+    dispatch_ms = min(d[0] for d in dispatch)
+    heavy = sorted(set(m for d in dispatch for m in d[1]))
+
+    print('import:   {:7.2f} ms (budget {:.0f} ms)'.format(import_ms, args.import_budget))
+    print('dispatch: {:7.2f} ms (budget {:.0f} ms)'.format(dispatch_ms, args.dispatch_budget))
+    print('heavy modules loaded before dispatch: {}'.format(', '.join(heavy) if heavy else 'none'))
+
+    ok = import_ms <= args.import_budget and dispatch_ms <= args.dispatch_budget and not heavy
+    print('OK' if ok else 'FAILED')
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,12 +6,17 @@
 ########################################################################
 
 import argparse
+import functools
 import os
 import sys
+import tempfile
 import json
-import requests
+import struct
+import hashlib
 import hmac
-from zeroconf import Zeroconf
+import io
+import threading
+import time
 from datetime import datetime, timedelta
 
 
@@ -40,8 +45,59 @@ g_app_desc = {
     "device_name": "FbxOS Client"
 }
 
+# Freebox root certificates required for HTTPS
+# see https://dev.freebox.fr/sdk/os/# for content below
+FBX_CA_CERTIFICATES = """-----BEGIN CERTIFICATE-----
+MIICWTCCAd+gAwIBAgIJAMaRcLnIgyukMAoGCCqGSM49BAMCMGExCzAJBgNVBAYT
+AkZSMQ8wDQYDVQQIDAZGcmFuY2UxDjAMBgNVBAcMBVBhcmlzMRMwEQYDVQQKDApG
+cmVlYm94IFNBMRwwGgYDVQQDDBNGcmVlYm94IEVDQyBSb290IENBMB4XDTE1MDkw
+MTE4MDIwN1oXDTM1MDgyNzE4MDIwN1owYTELMAkGA1UEBhMCRlIxDzANBgNVBAgM
+BkZyYW5jZTEOMAwGA1UEBwwFUGFyaXMxEzARBgNVBAoMCkZyZWVib3ggU0ExHDAa
+BgNVBAMME0ZyZWVib3ggRUNDIFJvb3QgQ0EwdjAQBgcqhkjOPQIBBgUrgQQAIgNi
+AASCjD6ZKn5ko6cU5Vxh8GA1KqRi6p2GQzndxHtuUmwY8RvBbhZ0GIL7bQ4f08ae
+JOv0ycWjEW0fyOnAw6AYdsN6y1eNvH2DVfoXQyGoCSvXQNAUxla+sJuLGICRYiZz
+mnijYzBhMB0GA1UdDgQWBBTIB3c2GlbV6EIh2ErEMJvFxMz/QTAfBgNVHSMEGDAW
+gBTIB3c2GlbV6EIh2ErEMJvFxMz/QTAPBgNVHRMBAf8EBTADAQH/MA4GA1UdDwEB
+/wQEAwIBhjAKBggqhkjOPQQDAgNoADBlAjA8tzEMRVX8vrFuOGDhvZr7OSJjbBr8
+gl2I70LeVNGEXZsAThUkqj5Rg9bV8xw3aSMCMQCDjB5CgsLH8EdZmiksdBRRKM2r
+vxo6c0dSSNrr7dDN+m2/dRvgoIpGL2GauOGqDFY=
+-----END CERTIFICATE-----
+-----BEGIN CERTIFICATE-----
+MIIFmjCCA4KgAwIBAgIJAKLyz15lYOrYMA0GCSqGSIb3DQEBCwUAMFoxCzAJBgNV
+BAYTAkZSMQ8wDQYDVQQIDAZGcmFuY2UxDjAMBgNVBAcMBVBhcmlzMRAwDgYDVQQK
+DAdGcmVlYm94MRgwFgYDVQQDDA9GcmVlYm94IFJvb3QgQ0EwHhcNMTUwNzMwMTUw
+OTIwWhcNMzUwNzI1MTUwOTIwWjBaMQswCQYDVQQGEwJGUjEPMA0GA1UECAwGRnJh
+bmNlMQ4wDAYDVQQHDAVQYXJpczEQMA4GA1UECgwHRnJlZWJveDEYMBYGA1UEAwwP
+RnJlZWJveCBSb290IENBMIICIjANBgkqhkiG9w0BAQEFAAOCAg8AMIICCgKCAgEA
+xqYIvq8538SH6BJ99jDlOPoyDBrlwKEp879oYplicTC2/p0X66R/ft0en1uSQadC
+sL/JTyfgyJAgI1Dq2Y5EYVT/7G6GBtVH6Bxa713mM+I/v0JlTGFalgMqamMuIRDQ
+tdyvqEIs8DcfGB/1l2A8UhKOFbHQsMcigxOe9ZodMhtVNn0mUyG+9Zgu1e/YMhsS
+iG4Kqap6TGtk80yruS1mMWVSgLOq9F5BGD4rlNlWLo0C3R10mFCpqvsFU+g4kYoA
+dTxaIpi1pgng3CGLE0FXgwstJz8RBaZObYEslEYKDzmer5zrU1pVHiwkjsgwbnuy
+WtM1Xry3Jxc7N/i1rxFmN/4l/Tcb1F7x4yVZmrzbQVptKSmyTEvPvpzqzdxVWuYi
+qIFSe/njl8dX9v5hjbMo4CeLuXIRE4nSq2A7GBm4j9Zb6/l2WIBpnCKtwUVlroKw
+NBgB6zHg5WI9nWGuy3ozpP4zyxqXhaTgrQcDDIG/SQS1GOXKGdkCcSa+VkJ0jTf5
+od7PxBn9/TuN0yYdgQK3YDjD9F9+CLp8QZK1bnPdVGywPfL1iztngF9J6JohTyL/
+VMvpWfS/X6R4Y3p8/eSio4BNuPvm9r0xp6IMpW92V8SYL0N6TQQxzZYgkLV7TbQI
+Hw6v64yMbbF0YS9VjS0sFpZcFERVQiodRu7nYNC1jy8CAwEAAaNjMGEwHQYDVR0O
+BBYEFD2erMkECujilR0BuER09FdsYIebMB8GA1UdIwQYMBaAFD2erMkECujilR0B
+uER09FdsYIebMA8GA1UdEwEB/wQFMAMBAf8wDgYDVR0PAQH/BAQDAgGGMA0GCSqG
+SIb3DQEBCwUAA4ICAQAZ2Nx8mWIWckNY8X2t/ymmCbcKxGw8Hn3BfTDcUWQ7GLRf
+MGzTqxGSLBQ5tENaclbtTpNrqPv2k6LY0VjfrKoTSS8JfXkm6+FUtyXpsGK8MrLL
+hZ/YdADTfbbWOjjD0VaPUoglvo2N4n7rOuRxVYIij11fL/wl3OUZ7GHLgL3qXSz0
++RGW+1oZo8HQ7pb6RwLfv42Gf+2gyNBckM7VVh9R19UkLCsHFqhFBbUmqwJgNA2/
+3twgV6Y26qlyHXXODUfV3arLCwFoNB+IIrde1E/JoOry9oKvF8DZTo/Qm6o2KsdZ
+dxs/YcIUsCvKX8WCKtH6la/kFCUcXIb8f1u+Y4pjj3PBmKI/1+Rs9GqB0kt1otyx
+Q6bqxqBSgsrkuhCfRxwjbfBgmXjIZ/a4muY5uMI0gbl9zbMFEJHDojhH6TUB5qd0
+JJlI61gldaT5Ci1aLbvVcJtdeGhElf7pOE9JrXINpP3NOJJaUSueAvxyj/WWoo0v
+4KO7njox8F6jCHALNDLdTsX0FTGmUZ/s/QfJry3VNwyjCyWDy1ra4KWoqt6U7SzM
+d5jENIZChM8TnDXJzqc+mu00cI3icn9bV9flYCXLTIsprB21wVSMh0XeBGylKxeB
+S27oDfFq04XSox7JM9HdTt2hLK96x1T7FpFrBTnALzb7vHv9MhXqAT90fPR/8A==
+-----END CERTIFICATE-----
+"""
 
 g_log_enabled = False
+g_json_loads = None
 
 
 def log(what):
@@ -57,6 +113,97 @@ def enable_log(is_enabled):
     g_log_enabled = is_enabled
 
 
+def is_log_enabled():
+    """Tell whether logs are enabled, to skip building costly log lines"""
+    return g_log_enabled
+
+
+def json_loads(data):
+    """Decode a JSON document given as bytes or str
+
+    orjson or ujson are used when installed, else the json module.
+    """
+    global g_json_loads
+    if g_json_loads is None:
+        g_json_loads = json.loads
+        for backend in ('orjson', 'ujson'):
+            try:
+                g_json_loads = __import__(backend).loads
+                break
+            except ImportError:
+                pass
+        log('JSON backend: {}'.format(g_json_loads.__module__))
+    return g_json_loads(data)
+
+
+class FbxOutputCapture:
+    """Stdout proxy redirecting what a thread prints into its own buffer
+
+    Threads which have not started a capture write to the wrapped stream.
+    """
+
+    def __init__(self, stream):
+        """Constructor"""
+        self._stream = stream
+        self._local = threading.local()
+
+    @property
+    def stream(self):
+        return self._stream
+
+    def start(self):
+        """Capture what current thread prints from now on"""
+        self._local.buffer = io.StringIO()
+
+    def stop(self):
+        """Stop capture for current thread and return what was printed"""
+        buf = self._local.buffer
+        self._local.buffer = None
+        return buf.getvalue()
+
+    def write(self, data):
+        buf = getattr(self._local, 'buffer', None)
+        return (buf if buf is not None else self._stream).write(data)
+
+    def flush(self):
+        buf = getattr(self._local, 'buffer', None)
+        if buf is None:
+            self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class FbxRenderer:
+    """Human readable output of a command, written at once
+
+    Lines are gathered while data is rendered, then written with a single
+    write by flush(): to stdout unless another stream is given.
+    """
+
+    def __init__(self, stream=None):
+        """Constructor"""
+        self._stream = stream
+        self._lines = []
+
+    def line(self, text=''):
+        """Add a line"""
+        self._lines.append(text)
+
+    def lines(self, texts):
+        """Add lines"""
+        self._lines.extend(texts)
+
+    def flush(self):
+        """Write the lines added so far"""
+        if not self._lines:
+            return
+        stream = self._stream if self._stream is not None else sys.stdout
+        stream.write('\n'.join(self._lines) + '\n')
+        stream.flush()
+        self._lines = []
+
+
 class FbxException(Exception):
     """ Exception for FreeboxOS domain """
 
@@ -67,6 +214,10 @@ class FbxException(Exception):
         return self.reason
 
 
+class FbxAuthException(FbxException):
+    """ Exception raised when FreeboxOS rejects the session token """
+
+
 class FbxConfiguration:
     """Configuration/registration management"""
 
@@ -75,9 +226,20 @@ class FbxConfiguration:
         self._app_desc = app_desc
         self._addr_file = 'fbxosctrl_addressing.txt'
         self._reg_file = 'fbxosctrl_registration.txt'
+        self._session_file = 'fbxosctrl_session.txt'
+        self._socket_file = 'fbxosctrl.sock'
+        self._cache_dir = 'fbxosctrl_cache'
+        self._tsdb_dir = 'fbxosctrl_tsdb'
+        self._calls_db = 'fbxosctrl_calls.db'
+        self._du_index_file = 'fbxosctrl_du.json'
+        # CA certificates file trusted instead of the Freebox ones (e.g. of a test server)
+        self._ca_file = os.environ.get('FBXOSCTRL_CA_FILE') or None
+        self._max_age = None
         self._addr_params = None
         self._reg_params = None
+        self._session_params = None
         self._resp_as_json = False
+        self._resp_as_ndjson = False
         self._conf_path = '.'
 
     @property
@@ -108,6 +270,78 @@ class FbxConfiguration:
     def reg_params(self, reg_params):
         self._reg_params = reg_params
         self._save_registration_params()
+        # a new registration makes any cached session obsolete
+        self.session_params = None
+
+    @property
+    def session_params(self):
+        """Return the cached session params if still valid, else None"""
+        if self._session_params is None:
+            self._load_session_params()
+        params = self._session_params
+        if not params:
+            return None
+        if params.get('expires', 0) <= time.time():
+            log('Cached session has expired')
+            return None
+        if self._reg_params is None or params.get('track_id') != self._reg_params.get('track_id'):
+            log('Cached session does not match current registration')
+            return None
+        return params
+
+    @session_params.setter
+    def session_params(self, session_params):
+        self._session_params = session_params
+        self._save_session_params()
+
+    @property
+    def socket_file(self):
+        return self._socket_file
+
+    @socket_file.setter
+    def socket_file(self, socket_file):
+        self._socket_file = socket_file
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    @property
+    def tsdb_dir(self):
+        return self._tsdb_dir
+
+    @property
+    def calls_db(self):
+        return self._calls_db
+
+    @property
+    def du_index_file(self):
+        return self._du_index_file
+
+    @property
+    def ca_file(self):
+        return self._ca_file
+
+    @ca_file.setter
+    def ca_file(self, ca_file):
+        self._ca_file = ca_file
+
+    def make_ssl_context(self):
+        """Build the SSL context verifying the box against the Freebox root certificates,
+        or against the ones of ca_file when set"""
+        import ssl
+        if self._ca_file:
+            return ssl.create_default_context(cafile=self._ca_file)
+        return ssl.create_default_context(cadata=FBX_CA_CERTIFICATES)
+
+    @property
+    def max_age(self):
+        """Max age (in seconds) of responses read from on-disk cache, None to disable it"""
+        return self._max_age
+
+    @max_age.setter
+    def max_age(self, max_age):
+        self._max_age = max_age
 
     @property
     def resp_as_json(self):
@@ -117,6 +351,15 @@ class FbxConfiguration:
     def resp_as_json(self, resp_as_json):
         self._resp_as_json = resp_as_json
 
+    @property
+    def resp_as_ndjson(self):
+        """JSON lines output: lists are returned as iterators on their items"""
+        return self._resp_as_ndjson
+
+    @resp_as_ndjson.setter
+    def resp_as_ndjson(self, resp_as_ndjson):
+        self._resp_as_ndjson = resp_as_ndjson
+
     @property
     def conf_path(self):
         return self._conf_path
@@ -129,6 +372,12 @@ class FbxConfiguration:
         self._conf_path = conf_path
         self._addr_file = self._conf_path + '/' + self._addr_file
         self._reg_file = self._conf_path + '/' + self._reg_file
+        self._session_file = self._conf_path + '/' + self._session_file
+        self._socket_file = self._conf_path + '/' + self._socket_file
+        self._cache_dir = self._conf_path + '/' + self._cache_dir
+        self._tsdb_dir = self._conf_path + '/' + self._tsdb_dir
+        self._calls_db = self._conf_path + '/' + self._calls_db
+        self._du_index_file = self._conf_path + '/' + self._du_index_file
 
     def load(self, want_regapp):
         """Load configuration params"""
@@ -150,6 +399,20 @@ class FbxConfiguration:
                 # print only if not in JSON format
                 print('Freebox Server is accessible via: {}'.format(url))
 
+    def load_registered(self):
+        """Load configuration params without output, for library use
+
+        Raise FbxException when the application is not registered yet.
+        Addressing params may be fetched via mDNS: this call blocks.
+        """
+        log('>>> load_registered')
+        self._load_addressing_params()
+        self._load_registration_params()
+        if self._reg_params is None:
+            raise FbxException(
+                "No registration params found in directory: {}, "
+                "launch 'fbxosctrl --regapp' once to register".format(self._conf_path))
+
     def has_registration_params(self):
         """ Indicate whether registration params look initialized """
         log('>>> has_registration_params')
@@ -176,6 +439,8 @@ class FbxConfiguration:
         print('Querying mDNS about Freebox Server information...')
         info = {}
         try:
+            # imported here as only needed when addressing params are unknown
+            from zeroconf import Zeroconf
             r = Zeroconf()
             serv_info = r.get_service_info('_fbx-api._tcp.local.', 'Freebox Server._fbx-api._tcp.local.')
             info['api_domain'] = serv_info.properties[b'api_domain'].decode()
@@ -186,6 +451,7 @@ class FbxConfiguration:
             r.close()
         except Exception:
             print('Unable to retrieve configuration, assuming bridged mode')
+            import requests
             d = requests.get("http://mafreebox.freebox.fr/api_version")
             data = d.json()
             info['api_domain'] = data['api_domain']
@@ -201,6 +467,29 @@ class FbxConfiguration:
         with open(self._reg_file, 'w') as of:
             json.dump(self._reg_params, of, indent=True, sort_keys=True)
 
+    def _save_session_params(self):
+        """ Save session parameters (token/permissions/expiry) to a local file """
+        log('>>> save_session_params')
+        if not self._session_params:
+            self._session_params = {}
+            if os.path.exists(self._session_file):
+                os.remove(self._session_file)
+            return
+        # the session token grants access to the box: keep it private
+        fd = os.open(self._session_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'w') as of:
+            json.dump(self._session_params, of, indent=True, sort_keys=True)
+
+    def _load_session_params(self):
+        log('>>> load_session_params: file: {}'.format(self._session_file))
+        self._session_params = {}
+        if os.path.exists(self._session_file):
+            try:
+                with open(self._session_file) as infile:
+                    self._session_params = json.load(infile)
+            except ValueError:
+                log('Ignoring corrupted session file')
+
     def _load_addressing_params(self):
         """Load existing addressing params or get them via mDNS"""
         if os.path.exists(self._addr_file):
@@ -226,6 +515,82 @@ class FbxConfiguration:
                 self._reg_params = json.load(infile)
 
 
+class FbxDiskCache:
+    """On-disk cache of FreeboxOS response bodies, shared between processes
+
+    One file per endpoint, its modification time being the response date.
+    Files are replaced atomically so that concurrent readers always read a
+    whole response. The oldest entries are evicted when size limits are hit.
+    """
+
+    def __init__(self, cache_dir, max_entries=128, max_bytes=16 * 1024 * 1024):
+        """Constructor"""
+        self._cache_dir = cache_dir
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+
+    def _path(self, uri):
+        return os.path.join(self._cache_dir, hashlib.sha1(uri.encode()).hexdigest() + '.json')
+
+    def load(self, uri, max_age):
+        """Return the cached body for uri if not older than max_age seconds, else None"""
+        path = self._path(uri)
+        try:
+            with open(path, 'rb') as infile:
+                if time.time() - os.fstat(infile.fileno()).st_mtime > max_age:
+                    return None
+                return infile.read()
+        except OSError:
+            return None
+
+    def store(self, uri, body):
+        """Cache the body for uri"""
+        try:
+            os.makedirs(self._cache_dir, mode=0o700, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self._cache_dir, suffix='.tmp')
+            with open(fd, 'wb') as of:
+                of.write(body)
+            os.replace(tmp_path, self._path(uri))
+        except OSError as exc:
+            log('Unable to store {} in cache: {}'.format(uri, exc))
+            return
+        self._evict()
+
+    def remove(self, uri):
+        """Drop the cached body for uri, if any"""
+        self._remove(self._path(uri))
+
+    def _evict(self):
+        """Remove the oldest entries exceeding the size limits"""
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self._cache_dir):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            if entry.name.endswith('.tmp'):
+                # left by a writer which died before renaming it
+                if now - st.st_mtime > 60:
+                    self._remove(entry.path)
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+
+        entries.sort(reverse=True)
+        total = 0
+        for count, (mtime, size, path) in enumerate(entries):
+            total += size
+            if count >= self._max_entries or total > self._max_bytes:
+                self._remove(path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            # already removed by another process
+            pass
+
+
 class FbxResponse:
     """"Response from Freebox"""
 
@@ -236,8 +601,8 @@ class FbxResponse:
 
     def __init__(self, jsonresp):
         """Constructor"""
-        # convert to obj
-        self._resp = json.loads(jsonresp)
+        # convert to obj, unless already decoded
+        self._resp = json_loads(jsonresp) if isinstance(jsonresp, (str, bytes)) else jsonresp
         # expected content checks
         if self._resp.get('success') is None:
             raise FbxException('Mandatory field missing: success')
@@ -276,237 +641,813 @@ class FbxResponse:
         return self._resp.get('error_code')
 
 
+class FbxResultDecoder:
+    """Incremental decoder of a FreeboxOS response whose result is a list
+
+    The body is fed chunk by chunk as it is received: each item of the result
+    list is yielded as soon as it is complete, so that only the item being
+    received is held in memory. Other fields of the response are kept, and
+    checked as a whole response (without its result) once the body is complete.
+    """
+
+    # returned by _decode when the value is not completely received yet
+    INCOMPLETE = object()
+
+    def __init__(self):
+        """Constructor"""
+        import codecs
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._state = 'start'
+        self._key = None
+        self._fields = {}
+
+    def feed(self, chunk):
+        """Decode a chunk of the body, yielding the result items it completes"""
+        self._buf = self._buf[self._pos:] + self._utf8.decode(chunk)
+        self._pos = 0
+        while True:
+            pos = self._skip_whitespaces()
+            if pos == len(self._buf):
+                return
+            c = self._buf[pos]
+            state = self._state
+            if state == 'start':
+                self._expect(c, '{', 'key')
+            elif state == 'key' and c == '}':
+                self._expect(c, '}', 'done')
+            elif state == 'key':
+                key = self._decode(pos, '"')
+                if key is FbxResultDecoder.INCOMPLETE:
+                    return
+                self._key = key
+                self._state = 'colon'
+            elif state == 'colon':
+                self._expect(c, ':', 'value')
+            elif state == 'value' and self._key == 'result' and c == '[':
+                self._expect(c, '[', 'first_item')
+            elif state == 'value':
+                value = self._decode(pos)
+                if value is FbxResultDecoder.INCOMPLETE:
+                    return
+                self._fields[self._key] = value
+                self._state = 'next_field'
+            elif state == 'next_field' and c == ',':
+                self._expect(c, ',', 'key')
+            elif state == 'next_field':
+                self._expect(c, '}', 'done')
+            elif state in ('first_item', 'item') and not (state == 'first_item' and c == ']'):
+                item = self._decode(pos)
+                if item is FbxResultDecoder.INCOMPLETE:
+                    return
+                self._state = 'next_item'
+                yield item
+            elif state in ('first_item', 'next_item') and c == ']':
+                self._expect(c, ']', 'next_field')
+            elif state == 'next_item':
+                self._expect(c, ',', 'item')
+            else:
+                raise FbxException('Invalid response: unexpected {!r}'.format(c))
+
+    def close(self):
+        """Check the whole body has been decoded, return the response without its result"""
+        if self._state != 'done' or self._skip_whitespaces() != len(self._buf):
+            raise FbxException('Truncated or invalid response')
+        resp = FbxResponse(self._fields)
+        if resp.result is not None:
+            raise FbxException('Result is not a list: {}'.format(type(resp.result).__name__))
+        return resp
+
+    def _skip_whitespaces(self):
+        while self._pos < len(self._buf) and self._buf[self._pos] in ' \t\r\n':
+            self._pos += 1
+        return self._pos
+
+    def _expect(self, c, expected, state):
+        if c != expected:
+            raise FbxException('Invalid response: expected {!r}, got {!r}'.format(expected, c))
+        self._pos += 1
+        self._state = state
+
+    def _decode(self, pos, expected=None):
+        """Decode the value at pos, INCOMPLETE if not completely received yet"""
+        if expected is not None and self._buf[pos] != expected:
+            raise FbxException('Invalid response: expected {!r}, got {!r}'.format(expected, self._buf[pos]))
+        try:
+            value, end = self._json.raw_decode(self._buf, pos)
+        except ValueError:
+            return FbxResultDecoder.INCOMPLETE
+        # a value is always followed by a separator: a number ending
+        # the buffer, or only followed by number characters (e.g. "6."
+        # of "6.5"), may still be incomplete
+        if end == len(self._buf):
+            return FbxResultDecoder.INCOMPLETE
+        if self._buf[pos] not in '{["' and not self._buf[end:].strip('0123456789.eE+-'):
+            return FbxResultDecoder.INCOMPLETE
+        self._pos = end
+        return value
+
+
+def make_http_adapter(ssl_context, **kwargs):
+    """Build the transport adapter verifying the box against an in-memory SSL context"""
+    # requests is slow to import: only load it once a request is to be sent
+    from requests.adapters import HTTPAdapter
+
+    class FbxHttpAdapter(HTTPAdapter):
+        """Transport adapter using the given SSL context"""
+
+        def init_poolmanager(self, *args, **kwargs):
+            kwargs['ssl_context'] = ssl_context
+            return super().init_poolmanager(*args, **kwargs)
+
+        def build_connection_pool_key_attributes(self, request, verify, cert=None):
+            host_params, pool_kwargs = super().build_connection_pool_key_attributes(request, verify, cert)
+            # same as below, for requests versions not calling cert_verify()
+            pool_kwargs.pop('ca_certs', None)
+            pool_kwargs.pop('ca_cert_dir', None)
+            return host_params, pool_kwargs
+
+        def cert_verify(self, conn, url, verify, cert):
+            # trusted certificates are already loaded in the SSL context: prevent
+            # requests from loading its default CA bundle file for each connection
+            conn.cert_reqs = 'CERT_REQUIRED'
+            conn.ca_certs = None
+            conn.ca_cert_dir = None
+
+    return FbxHttpAdapter(**kwargs)
+
+
+class FbxPendingRequest:
+    """Request in progress, whose response is awaited by other threads"""
+
+    def __init__(self):
+        """Constructor"""
+        self.done = threading.Event()
+        self.resp = None
+        self.error = None
+
+    def wait(self):
+        """Wait for the response, raising the request error if any"""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.resp
+
+
+class FbxRateLimiter:
+    """Space out calls made from any thread so that at most 'rate' are made per second"""
+
+    def __init__(self, rate=None):
+        """Constructor, no limit being applied if rate is None"""
+        self._interval = 1.0 / rate if rate else 0.0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        """Wait for the next call slot"""
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self._interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
 class FbxHttp():
     """"HTTP transporter"""
 
+    # error codes meaning the session token is no longer accepted by the box
+    AUTH_ERROR_CODES = ('auth_required', 'invalid_session')
+
+    # time (in seconds) a GET response is served from cache, per endpoint.
+    # Endpoints not listed here are never cached.
+    CACHE_TTL = {
+        '/system': 5,
+        '/connection': 1,
+        '/connection/xdsl': 5,
+        '/connection/ftth': 5,
+        '/storage/disk/': 10,
+        '/wifi/config/': 5,
+        '/wifi/planning/': 5,
+        '/dhcp/config/': 30,
+        '/dhcp/dynamic_lease/': 5,
+        '/fw/redir/': 30,
+        '/call/log/': 5,
+        '/downloads/': 2,
+    }
+
     def __init__(self, conf):
         """Constructor"""
         self._conf = conf
         self._http_timeout = 30
+        self._session_ttl = 1800
+        self._pool_maxsize = 8
+        self._stream_chunk_size = 16384
         self._is_logged_in = False
+        self._lock = threading.RLock()
         self._challenge = None
         self._session_token = None
-        self._certificates_file = 'fbxosctrl_certificates.txt'
-        self._make_certificate_chain()
+        self._permissions = None
+        # connection pool is built on first request
+        self._session = None
+        # uri => (expiration time, FbxResponse)
+        self._cache = {}
+        self._disk_cache = None
+        # uri => FbxPendingRequest, for GET requests in progress
+        self._pending = {}
 
-    def __del__(self):
-        """Logout on deletion"""
-        if self._is_logged_in:
-            try:
-                self._logout()
-            except Exception:
-                pass
+    @property
+    def session(self):
+        """Return the keep-alive connection pool shared by all requests"""
+        with self._lock:
+            if self._session is None:
+                self._session = self._make_session()
+        return self._session
+
+    def _make_session(self):
+        """Build the keep-alive connection pool"""
+        import requests
+        session = requests.Session()
+        adapter = make_http_adapter(
+            self._conf.make_ssl_context(), pool_connections=1, pool_maxsize=self._pool_maxsize)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    @property
+    def connection_stats(self):
+        """Return the number of connections opened and reused so far"""
+        opened = 0
+        requests_nb = 0
+        if self._session is None:
+            return {'opened': 0, 'reused': 0, 'requests': 0}
+        for adapter in set(self._session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    opened += pool.num_connections
+                    requests_nb += pool.num_requests
+        return {'opened': opened, 'reused': requests_nb - opened, 'requests': requests_nb}
 
     @property
     def headers(self):
         """Build headers"""
+        return FbxHttp._headers(self._session_token)
+
+    @staticmethod
+    def _headers(token):
+        """Build headers of requests sent with the session token (None if not logged in)"""
         h = {'Content-type': 'application/json', 'Accept': 'application/json'}
-        if self._session_token != None:
-            h['X-Fbx-App-Auth'] = self._session_token
+        if token != None:
+            h['X-Fbx-App-Auth'] = token
         return h
 
-    def get(self, uri, timeout=None, no_login=False):
-        """GET request"""
-        log(">>> get")
-        if not no_login:
-            self._login()
+    @property
+    def permissions(self):
+        """Return the permissions granted to the current session"""
+        return self._permissions
 
-        url = self._conf.api_address(uri)
-        log('GET url: {}'.format(url))
+    def get(self, uri, timeout=None, no_login=False, cached=True):
+        """GET request, served from cache when a recent response is available
 
-        r = requests.get(
-            url,
-            verify=self._certificates_file,
-            headers=self.headers,
-            timeout=timeout if timeout != None else self._http_timeout)
-        log('GET response: {}'.format(r.text))
+        With cached set to False, a fresh response is always requested.
+        """
+        log(">>> get")
+        if no_login:
+            return self._request('GET', uri, None, timeout, no_login)
+        resp = self._cache_lookup(uri) if cached else None
+        if resp is None:
+            resp = self._coalesced_get(uri, timeout, cached)
+        return resp
 
-        # ensure status_code is 200, else raise exception
-        if requests.codes.ok != r.status_code:
-            raise FbxException('GET error - http_status: {} {}'.format(r.status_code, r.text))
+    def iter_result(self, uri, timeout=None):
+        """GET request on a list endpoint, yielding the result items one at a time
+
+        Unless a cached response is available, the response is decoded while it
+        is received, without holding the whole body nor the whole result.
+        Streamed responses are not cached.
+        """
+        log(">>> iter_result")
+        resp = self._cache_lookup(uri)
+        if resp is not None:
+            yield from resp.result or []
+            return
+
+        r = self._request('GET', uri, None, timeout, False, stream=True)
+        decoder = FbxResultDecoder()
+        with r:
+            for chunk in r.iter_content(self._stream_chunk_size):
+                yield from decoder.feed(chunk)
+        resp = decoder.close()
+        if not resp.success:
+            raise FbxException('Request failure: {}'.format(resp))
 
-        return FbxResponse.build(r.text)
+    def get_content(self, uri, start=0, end=None, timeout=None):
+        """GET request on raw content (e.g. a file on /dl/), from byte start to end included
+
+        The HTTP response is returned with its body not read yet, for it to be
+        read by chunks. Its status is 206 if the range was honoured, else 200
+        with the whole content.
+        """
+        log(">>> get_content")
+        headers = {}
+        if start or end is not None:
+            headers['Range'] = 'bytes={}-{}'.format(start, '' if end is None else end)
+        return self._request('GET', uri, None, timeout, False, stream=True, headers=headers)
+
+    def _coalesced_get(self, uri, timeout, cached=True):
+        """GET request, threads requesting the same uri meanwhile waiting for its response
+
+        The response is only stored in the on-disk cache if cached is set.
+        """
+        with self._lock:
+            pending = self._pending.get(uri)
+            is_owner = pending is None
+            if is_owner:
+                pending = FbxPendingRequest()
+                self._pending[uri] = pending
+        if not is_owner:
+            log('GET {} already in progress: waiting for it'.format(uri))
+            return pending.wait()
+
+        try:
+            resp = self._request('GET', uri, None, timeout, False)
+            self._cache_store(uri, resp, persist=cached)
+            pending.resp = resp
+            return resp
+        except Exception as exc:
+            pending.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._pending[uri]
+            pending.done.set()
 
     def put(self, uri, data, timeout=None, no_login=False):
         """PUT request"""
         log(">>> put")
-        if not no_login:
-            self._login()
-
-        url = self._conf.api_address(uri)
-        jdata = json.dumps(data)
-        log('PUT url: {} data: {}'.format(url, jdata))
-
-        r = requests.put(
-            url,
-            verify=self._certificates_file,
-            data=jdata,
-            headers=self.headers,
-            timeout=timeout if timeout != None else self._http_timeout)
-        log('PUT response: {}'.format(r.text))
-
-        # ensure status_code is 200, else raise exception
-        if requests.codes.ok != r.status_code:
-            raise FbxException('PUT error - http_status: {} {}'.format(r.status_code, r.text))
-
-        return FbxResponse.build(r.text)
+        self._cache_invalidate(uri)
+        return self._request('PUT', uri, data, timeout, no_login)
 
-    def post(self, uri, data={}, timeout=None, no_login=False):
-        """POST request"""
+    def post(self, uri, data={}, timeout=None, no_login=False, form=False):
+        """POST request, data being sent form-urlencoded instead of JSON if form is set"""
         log(">>> post")
-        if not no_login:
-            self._login()
+        self._cache_invalidate(uri)
+        return self._request('POST', uri, data, timeout, no_login, form=form)
 
+    @property
+    def disk_cache(self):
+        """Return the on-disk cache, None if disabled (no max age set)"""
+        if self._conf.max_age is None:
+            return None
+        if self._disk_cache is None:
+            self._disk_cache = FbxDiskCache(self._conf.cache_dir)
+        return self._disk_cache
+
+    def _cache_lookup(self, uri):
+        """Return the cached response for uri if still valid, else None"""
+        with self._lock:
+            entry = self._cache.get(uri)
+        if entry is not None and entry[0] > time.monotonic():
+            log('GET {} served from cache'.format(uri))
+            return entry[1]
+
+        disk_cache = self.disk_cache
+        if disk_cache is not None:
+            body = disk_cache.load(uri, self._conf.max_age)
+            if body is not None:
+                log('GET {} served from disk cache'.format(uri))
+                return FbxResponse.build(body)
+        return None
+
+    def _cache_store(self, uri, resp, persist=True):
+        """Cache a successful response for the TTL of its endpoint
+
+        Unless persist is unset, it is also stored in the on-disk cache: only
+        endpoints with a TTL are, so that invalidation can reach them.
+        """
+        if not resp.success:
+            return
+        ttl = FbxHttp.CACHE_TTL.get(uri)
+        if not ttl:
+            return
+        with self._lock:
+            self._cache[uri] = (time.monotonic() + ttl, resp)
+
+        disk_cache = self.disk_cache
+        if disk_cache is not None and persist:
+            disk_cache.store(uri, json.dumps(resp.whole_content).encode())
+
+    def _cache_invalidate(self, uri):
+        """Drop cached responses of the resource modified by a request on uri
+
+        Responses stored in the on-disk cache are dropped too, even when it is
+        not used by this process, for next runs not to read them.
+        """
+        path = uri.rstrip('/')
+
+        def modified(key):
+            cached = key.rstrip('/')
+            return cached.startswith(path) or path.startswith(cached)
+
+        with self._lock:
+            for key in list(self._cache):
+                if modified(key):
+                    del self._cache[key]
+
+        if os.path.isdir(self._conf.cache_dir):
+            disk_cache = FbxDiskCache(self._conf.cache_dir)
+            for key in FbxHttp.CACHE_TTL:
+                if modified(key):
+                    disk_cache.remove(key)
+
+    def _request(self, method, uri, data, timeout, no_login, **kwargs):
+        """Send request, logging in again and retrying once if the session was rejected
+
+        kwargs are the options of _send. Other threads may log in again
+        meanwhile: the request is sent with the token read along its login.
+        """
+        if no_login:
+            with self._lock:
+                token = self._session_token
+            return self._send(method, uri, data, timeout, token, **kwargs)
+
+        token = self._login()
+        try:
+            return self._send(method, uri, data, timeout, token, **kwargs)
+        except FbxAuthException:
+            log('Session rejected by Freebox Server: login again')
+            with self._lock:
+                # another thread may have already opened a new session
+                if self._session_token == token:
+                    self._invalidate_session()
+            token = self._login()
+            return self._send(method, uri, data, timeout, token, **kwargs)
+
+    def _send(self, method, uri, data, timeout, token, stream=False, form=False, headers=None):
+        """Send a single request with the session token and check its HTTP status
+
+        FbxAuthException is raised if token was sent and rejected. With stream
+        set, the body of a successful (or partial content) response is not
+        read: the HTTP response is returned instead of a FbxResponse. With form
+        set, data is sent form-urlencoded. headers are added to the request ones.
+        """
         url = self._conf.api_address(uri)
-        jdata = json.dumps(data)
-        log('POST url: {} data: {}'.format(url, jdata))
+        headers = dict(FbxHttp._headers(token), **(headers or {}))
+        if form:
+            import urllib.parse
+            jdata = urllib.parse.urlencode(data)
+            headers['Content-type'] = 'application/x-www-form-urlencoded'
+        else:
+            jdata = json.dumps(data) if data is not None else None
+        if jdata is None:
+            log('{} url: {}'.format(method, url))
+        else:
+            log('{} url: {} data: {}'.format(method, url, jdata))
 
-        r = requests.post(
+        r = self.session.request(
+            method,
             url,
-            verify=self._certificates_file,
             data=jdata,
-            headers=self.headers,
-            timeout=timeout if timeout != None else self._http_timeout)
-        log('POST response: {}'.format(r.text))
+            headers=headers,
+            timeout=timeout if timeout != None else self._http_timeout,
+            stream=stream)
+        if stream and r.status_code in (200, 206):
+            log('{} response: streamed'.format(method))
+            return r
+        # FreeboxOS replies in UTF-8 JSON: the body is parsed as bytes,
+        # sparing the charset detection done by r.text
+        body = r.content
+        if is_log_enabled():
+            log('{} response: {}'.format(method, body.decode('utf-8', 'replace')))
 
         # ensure status_code is 200, else raise exception
-        if requests.codes.ok != r.status_code:
-            raise FbxException('POST error - http_status: {} {}'.format(r.status_code, r.text))
+        if r.status_code != 200:
+            text = body.decode('utf-8', 'replace')
+            if token is not None and self._is_auth_error(text):
+                raise FbxAuthException('{} error - http_status: {} {}'.format(method, r.status_code, text))
+            raise FbxException('{} error - http_status: {} {}'.format(method, r.status_code, text))
 
-        return FbxResponse.build(r.text)
+        return FbxResponse.build(body)
+
+    def _is_auth_error(self, text):
+        """Tell whether an error reply means the session token was rejected"""
+        try:
+            return json.loads(text).get('error_code') in FbxHttp.AUTH_ERROR_CODES
+        except (ValueError, AttributeError):
+            return False
 
     def _login(self):
-        """ Login to FreeboxOS using API credentials """
+        """ Login to FreeboxOS using API credentials, return the session token """
         log(">>> _login")
-        if not self._is_logged_in:
-            self._session_token = None
-
-            # 1st stage: get challenge
-            resp = self.get('/login', no_login=True)
-
-            if resp.success:
-                if not resp.result.get('logged_in'):
-                    self._challenge = resp.result.get('challenge')
-            else:
-                raise FbxException('Challenge failure: {}'.format(resp))
-
-            # 2nd stage: open a session
-            app_token = self._conf.reg_params.get('app_token')
-            log('challenge: {}, apptoken: {}'.format(self._challenge, app_token))
-            # Hashing token with key
-            password = hmac.new(app_token.encode(), self._challenge.encode(), 'sha1').hexdigest()
-            uri = '/login/session/'
-            payload = {'app_id': self._conf.app_desc.get('app_id'), 'password': password}
-            # post it
-            resp = self.post(uri, payload, no_login=True)
-
-            if resp.success:
-                self._session_token = resp.result.get('session_token')
-                permissions = resp.result.get('permissions')
-                log('Permissions: {}'.format(permissions))
-                if not permissions.get('settings'):
-                    print(
-                        "Warning: permission 'settings' has not been allowed yet" +
-                        ' in FreeboxOS server. This script may fail!')
-            else:
-                raise FbxException('Session failure: {}'.format(resp))
+        # requests may be sent from several threads: only one of them logs in
+        with self._lock:
+            if not self._is_logged_in:
+                self._open_session()
+            return self._session_token
+
+    def _open_session(self):
+        """ Open a session, reusing the cached one if still valid """
+        # reuse the session opened by a previous run if still valid
+        if self._use_cached_session():
+            return
+
+        # 1st stage: get challenge
+        resp = self.get('/login', no_login=True)
+        self._challenge_received(resp)
+
+        # 2nd stage: open a session
+        resp = self.post('/login/session/', self._session_payload(), no_login=True)
+        self._session_opened(resp)
+
+    def _use_cached_session(self):
+        """Use the session cached by a previous run if still valid"""
+        self._session_token = None
+        session = self._conf.session_params
+        if session is None:
+            return False
+        log('Reusing cached session')
+        self._session_token = session.get('session_token')
+        self._permissions = session.get('permissions')
+        self._is_logged_in = True
+        return True
 
-            # set headers for next dialogs
-            self._is_logged_in = True
+    def _challenge_received(self, resp):
+        """Handle the reply to the login challenge request"""
+        if resp.success:
+            if not resp.result.get('logged_in'):
+                self._challenge = resp.result.get('challenge')
+        else:
+            raise FbxException('Challenge failure: {}'.format(resp))
+
+    def _session_payload(self):
+        """Build the session opening request content"""
+        app_token = self._conf.reg_params.get('app_token')
+        log('challenge: {}, apptoken: {}'.format(self._challenge, app_token))
+        # Hashing token with key
+        password = hmac.new(app_token.encode(), self._challenge.encode(), 'sha1').hexdigest()
+        return {'app_id': self._conf.app_desc.get('app_id'), 'password': password}
+
+    def _session_opened(self, resp):
+        """Handle the reply to the session opening request"""
+        if resp.success:
+            self._session_token = resp.result.get('session_token')
+            self._permissions = resp.result.get('permissions')
+            log('Permissions: {}'.format(self._permissions))
+            if not self._permissions.get('settings'):
+                print(
+                    "Warning: permission 'settings' has not been allowed yet" +
+                    ' in FreeboxOS server. This script may fail!')
+        else:
+            raise FbxException('Session failure: {}'.format(resp))
+
+        # save session for next runs
+        self._conf.session_params = {
+            'session_token': self._session_token,
+            'permissions': self._permissions,
+            'track_id': self._conf.reg_params.get('track_id'),
+            'expires': time.time() + self._session_ttl}
+        self._is_logged_in = True
+
+    def _invalidate_session(self):
+        """Forget current session, both in memory and in cache"""
+        self._session_token = None
+        self._permissions = None
+        self._is_logged_in = False
+        self._conf.session_params = None
 
     def _logout(self):
         """ logout from FreeboxOS """
         log(">>> _logout")
         if self._is_logged_in:
-            url = self._conf.api_address('/login/logout/')
-            resp = self._http.post(url, headers=self.headers)
-
-            # reset headers as no more dialogs expected
-            self._http_headers = None
+            resp = self._send('POST', '/login/logout/', {}, None, self._session_token)
 
             if not resp.success:
                 raise FbxException('Logout failure: {}'.format(resp))
-        self._session_token = None
-        self._is_logged_in = False
+        self._invalidate_session()
 
-    def _make_certificate_chain(self):
-        """Store the certificate chain required for HTTPS"""
-        with open(self._certificates_file, 'w') as of:
-            of.write(
-                # see https://dev.freebox.fr/sdk/os/# for content below
-"""-----BEGIN CERTIFICATE-----
-MIICWTCCAd+gAwIBAgIJAMaRcLnIgyukMAoGCCqGSM49BAMCMGExCzAJBgNVBAYT
-AkZSMQ8wDQYDVQQIDAZGcmFuY2UxDjAMBgNVBAcMBVBhcmlzMRMwEQYDVQQKDApG
-cmVlYm94IFNBMRwwGgYDVQQDDBNGcmVlYm94IEVDQyBSb290IENBMB4XDTE1MDkw
-MTE4MDIwN1oXDTM1MDgyNzE4MDIwN1owYTELMAkGA1UEBhMCRlIxDzANBgNVBAgM
-BkZyYW5jZTEOMAwGA1UEBwwFUGFyaXMxEzARBgNVBAoMCkZyZWVib3ggU0ExHDAa
-BgNVBAMME0ZyZWVib3ggRUNDIFJvb3QgQ0EwdjAQBgcqhkjOPQIBBgUrgQQAIgNi
-AASCjD6ZKn5ko6cU5Vxh8GA1KqRi6p2GQzndxHtuUmwY8RvBbhZ0GIL7bQ4f08ae
-JOv0ycWjEW0fyOnAw6AYdsN6y1eNvH2DVfoXQyGoCSvXQNAUxla+sJuLGICRYiZz
-mnijYzBhMB0GA1UdDgQWBBTIB3c2GlbV6EIh2ErEMJvFxMz/QTAfBgNVHSMEGDAW
-gBTIB3c2GlbV6EIh2ErEMJvFxMz/QTAPBgNVHRMBAf8EBTADAQH/MA4GA1UdDwEB
-/wQEAwIBhjAKBggqhkjOPQQDAgNoADBlAjA8tzEMRVX8vrFuOGDhvZr7OSJjbBr8
-gl2I70LeVNGEXZsAThUkqj5Rg9bV8xw3aSMCMQCDjB5CgsLH8EdZmiksdBRRKM2r
-vxo6c0dSSNrr7dDN+m2/dRvgoIpGL2GauOGqDFY=
------END CERTIFICATE-----
------BEGIN CERTIFICATE-----
-MIIFmjCCA4KgAwIBAgIJAKLyz15lYOrYMA0GCSqGSIb3DQEBCwUAMFoxCzAJBgNV
-BAYTAkZSMQ8wDQYDVQQIDAZGcmFuY2UxDjAMBgNVBAcMBVBhcmlzMRAwDgYDVQQK
-DAdGcmVlYm94MRgwFgYDVQQDDA9GcmVlYm94IFJvb3QgQ0EwHhcNMTUwNzMwMTUw
-OTIwWhcNMzUwNzI1MTUwOTIwWjBaMQswCQYDVQQGEwJGUjEPMA0GA1UECAwGRnJh
-bmNlMQ4wDAYDVQQHDAVQYXJpczEQMA4GA1UECgwHRnJlZWJveDEYMBYGA1UEAwwP
-RnJlZWJveCBSb290IENBMIICIjANBgkqhkiG9w0BAQEFAAOCAg8AMIICCgKCAgEA
-xqYIvq8538SH6BJ99jDlOPoyDBrlwKEp879oYplicTC2/p0X66R/ft0en1uSQadC
-sL/JTyfgyJAgI1Dq2Y5EYVT/7G6GBtVH6Bxa713mM+I/v0JlTGFalgMqamMuIRDQ
-tdyvqEIs8DcfGB/1l2A8UhKOFbHQsMcigxOe9ZodMhtVNn0mUyG+9Zgu1e/YMhsS
-iG4Kqap6TGtk80yruS1mMWVSgLOq9F5BGD4rlNlWLo0C3R10mFCpqvsFU+g4kYoA
-dTxaIpi1pgng3CGLE0FXgwstJz8RBaZObYEslEYKDzmer5zrU1pVHiwkjsgwbnuy
-WtM1Xry3Jxc7N/i1rxFmN/4l/Tcb1F7x4yVZmrzbQVptKSmyTEvPvpzqzdxVWuYi
-qIFSe/njl8dX9v5hjbMo4CeLuXIRE4nSq2A7GBm4j9Zb6/l2WIBpnCKtwUVlroKw
-NBgB6zHg5WI9nWGuy3ozpP4zyxqXhaTgrQcDDIG/SQS1GOXKGdkCcSa+VkJ0jTf5
-od7PxBn9/TuN0yYdgQK3YDjD9F9+CLp8QZK1bnPdVGywPfL1iztngF9J6JohTyL/
-VMvpWfS/X6R4Y3p8/eSio4BNuPvm9r0xp6IMpW92V8SYL0N6TQQxzZYgkLV7TbQI
-Hw6v64yMbbF0YS9VjS0sFpZcFERVQiodRu7nYNC1jy8CAwEAAaNjMGEwHQYDVR0O
-BBYEFD2erMkECujilR0BuER09FdsYIebMB8GA1UdIwQYMBaAFD2erMkECujilR0B
-uER09FdsYIebMA8GA1UdEwEB/wQFMAMBAf8wDgYDVR0PAQH/BAQDAgGGMA0GCSqG
-SIb3DQEBCwUAA4ICAQAZ2Nx8mWIWckNY8X2t/ymmCbcKxGw8Hn3BfTDcUWQ7GLRf
-MGzTqxGSLBQ5tENaclbtTpNrqPv2k6LY0VjfrKoTSS8JfXkm6+FUtyXpsGK8MrLL
-hZ/YdADTfbbWOjjD0VaPUoglvo2N4n7rOuRxVYIij11fL/wl3OUZ7GHLgL3qXSz0
-+RGW+1oZo8HQ7pb6RwLfv42Gf+2gyNBckM7VVh9R19UkLCsHFqhFBbUmqwJgNA2/
-3twgV6Y26qlyHXXODUfV3arLCwFoNB+IIrde1E/JoOry9oKvF8DZTo/Qm6o2KsdZ
-dxs/YcIUsCvKX8WCKtH6la/kFCUcXIb8f1u+Y4pjj3PBmKI/1+Rs9GqB0kt1otyx
-Q6bqxqBSgsrkuhCfRxwjbfBgmXjIZ/a4muY5uMI0gbl9zbMFEJHDojhH6TUB5qd0
-JJlI61gldaT5Ci1aLbvVcJtdeGhElf7pOE9JrXINpP3NOJJaUSueAvxyj/WWoo0v
-4KO7njox8F6jCHALNDLdTsX0FTGmUZ/s/QfJry3VNwyjCyWDy1ra4KWoqt6U7SzM
-d5jENIZChM8TnDXJzqc+mu00cI3icn9bV9flYCXLTIsprB21wVSMh0XeBGylKxeB
-S27oDfFq04XSox7JM9HdTt2hLK96x1T7FpFrBTnALzb7vHv9MhXqAT90fPR/8A==
------END CERTIFICATE-----
-""")
 
+class AsyncFbxHttp(FbxHttp):
+    """"Asynchronous HTTP transporter, for use from an asyncio event loop
 
-class FbxService:
-    """"Service base class"""
+    Same login flow and session cache as FbxHttp, but requests are coroutines
+    sent over a single aiohttp session: concurrent requests share the session
+    token and the connection pool. Requires the aiohttp package.
+    """
 
-    def __init__(self, http, conf):
+    def __init__(self, conf):
         """Constructor"""
-        self._http = http
-        self._conf = conf
+        super().__init__(conf)
+        self._async_lock = None
+        # uri => future of its response, for GET requests in progress
+        self._async_pending = {}
 
-    def get_service_data(self, uri):
-        """Get service data"""
-        resp = self._http.get(uri)
-        if not resp.success:
-            raise FbxException('Request failure: {}'.format(resp))
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    @property
+    def session(self):
+        """Return the aiohttp session shared by all requests"""
+        if self._session is None:
+            self._session = self._make_session()
+        return self._session
+
+    def _make_session(self):
+        """Build the aiohttp session and its keep-alive connection pool"""
+        try:
+            import aiohttp
+        except ImportError:
+            raise FbxException('Package aiohttp is required for asynchronous requests')
+        connector = aiohttp.TCPConnector(ssl=self._conf.make_ssl_context(), limit=self._pool_maxsize)
+        return aiohttp.ClientSession(connector=connector)
 
+    @property
+    def connection_stats(self):
+        """Not available for aiohttp connection pool"""
+        return None
+
+    async def close(self):
+        """Close the connection pool"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def get(self, uri, timeout=None, no_login=False):
+        """GET request, served from cache when a recent response is available"""
+        log(">>> async get")
+        if no_login:
+            return await self._request('GET', uri, None, timeout, no_login)
+        resp = self._cache_lookup(uri)
+        if resp is None:
+            resp = await self._coalesced_get(uri, timeout)
         return resp
 
+    def iter_result(self, uri, timeout=None):
+        """Not available: responses of asynchronous requests are read at once"""
+        raise NotImplementedError('iter_result is not available for asynchronous requests')
 
-class FbxServiceAuth(FbxService):
-    """"Authentication domain"""
+    def get_content(self, uri, start=0, end=None, timeout=None):
+        """Not available: responses of asynchronous requests are read at once"""
+        raise NotImplementedError('get_content is not available for asynchronous requests')
 
-    def __init__(self, http, conf):
-        """Constructor"""
-        super().__init__(http, conf)
+    async def _coalesced_get(self, uri, timeout, cached=True):
+        """GET request, tasks requesting the same uri meanwhile awaiting its response
+
+        The response is only stored in the on-disk cache if cached is set.
+        """
+        import asyncio
+        pending = self._async_pending.get(uri)
+        if pending is not None:
+            log('GET {} already in progress: waiting for it'.format(uri))
+            # a cancelled waiter must not cancel the request of the others
+            return await asyncio.shield(pending)
+
+        pending = asyncio.get_running_loop().create_future()
+        self._async_pending[uri] = pending
+        try:
+            resp = await self._request('GET', uri, None, timeout, False)
+            self._cache_store(uri, resp, persist=cached)
+            pending.set_result(resp)
+            return resp
+        except Exception as exc:
+            pending.set_exception(exc)
+            # retrieved here, not to be reported when no task waits for it
+            pending.exception()
+            raise
+        finally:
+            del self._async_pending[uri]
+            if not pending.done():
+                pending.cancel()
+
+    async def put(self, uri, data, timeout=None, no_login=False):
+        """PUT request"""
+        log(">>> async put")
+        self._cache_invalidate(uri)
+        return await self._request('PUT', uri, data, timeout, no_login)
+
+    async def post(self, uri, data={}, timeout=None, no_login=False):
+        """POST request"""
+        log(">>> async post")
+        self._cache_invalidate(uri)
+        return await self._request('POST', uri, data, timeout, no_login)
+
+    async def _request(self, method, uri, data, timeout, no_login):
+        """Send request, logging in again and retrying once if the session was rejected
+
+        Other tasks may log in again meanwhile: the request is sent with the
+        token read along its login.
+        """
+        if no_login:
+            return await self._send(method, uri, data, timeout, self._session_token)
+
+        token = await self._login()
+        try:
+            return await self._send(method, uri, data, timeout, token)
+        except FbxAuthException:
+            log('Session rejected by Freebox Server: login again')
+            # another task may have already opened a new session
+            if self._session_token == token:
+                self._invalidate_session()
+            token = await self._login()
+            return await self._send(method, uri, data, timeout, token)
+
+    async def _send(self, method, uri, data, timeout, token):
+        """Send a single request with the session token and check its HTTP status
+
+        FbxAuthException is raised if token was sent and rejected.
+        """
+        import aiohttp
+        url = self._conf.api_address(uri)
+        jdata = json.dumps(data) if data is not None else None
+        if jdata is None:
+            log('{} url: {}'.format(method, url))
+        else:
+            log('{} url: {} data: {}'.format(method, url, jdata))
+
+        async with self.session.request(
+                method,
+                url,
+                data=jdata,
+                headers=FbxHttp._headers(token),
+                timeout=aiohttp.ClientTimeout(total=timeout if timeout != None else self._http_timeout)) as r:
+            body = await r.read()
+        if is_log_enabled():
+            log('{} response: {}'.format(method, body.decode('utf-8', 'replace')))
+
+        # ensure status_code is 200, else raise exception
+        if r.status != 200:
+            text = body.decode('utf-8', 'replace')
+            if token is not None and self._is_auth_error(text):
+                raise FbxAuthException('{} error - http_status: {} {}'.format(method, r.status, text))
+            raise FbxException('{} error - http_status: {} {}'.format(method, r.status, text))
+
+        return FbxResponse.build(body)
+
+    async def _login(self):
+        """ Login to FreeboxOS using API credentials, return the session token """
+        log(">>> async _login")
+        if self._async_lock is None:
+            import asyncio
+            self._async_lock = asyncio.Lock()
+        # concurrent tasks wait for the first one to log in
+        async with self._async_lock:
+            if not self._is_logged_in:
+                await self._open_session()
+            return self._session_token
+
+    async def _open_session(self):
+        """ Open a session, reusing the cached one if still valid """
+        if self._use_cached_session():
+            return
+
+        resp = await self.get('/login', no_login=True)
+        self._challenge_received(resp)
+
+        resp = await self.post('/login/session/', self._session_payload(), no_login=True)
+        self._session_opened(resp)
+
+    async def _logout(self):
+        """ logout from FreeboxOS """
+        log(">>> async _logout")
+        if self._is_logged_in:
+            resp = await self._send('POST', '/login/logout/', {}, None, self._session_token)
+
+            if not resp.success:
+                raise FbxException('Logout failure: {}'.format(resp))
+        self._invalidate_session()
+
+
+class FbxService:
+    """"Service base class"""
+
+    def __init__(self, http, conf):
+        """Constructor"""
+        self._http = http
+        self._conf = conf
+
+    def get_service_data(self, uri, cached=True):
+        """Get service data"""
+        resp = self._http.get(uri, cached=cached)
+        if not resp.success:
+            raise FbxException('Request failure: {}'.format(resp))
+
+        return resp
+
+
+class FbxServiceAuth(FbxService):
+    """"Authentication domain"""
+
+    def __init__(self, http, conf):
+        """Constructor"""
+        super().__init__(http, conf)
         self._registered = False
 
     def is_registered(self):
@@ -611,17 +1552,24 @@ class FbxServiceSystem(FbxService):
         if self._conf.resp_as_json:
             return resp.whole_content
 
-        print('Server info:')
-        print(' - Model:     {}'.format(resp.result['model_info']['pretty_name']))
-        print(' - MAC:       {}'.format(resp.result['mac']))
-        print(' - Firmware:  {}'.format(resp.result['firmware_version']))
-        print(' - Uptime:    {}'.format(resp.result['uptime']))
-        print(' - Sensors:')
-        for sensor in resp.result['sensors']:
-            unit = '°C' if sensor['id'].startswith('temp_') else ''
-            print('   - {:20} {}{}'.format(sensor['name'] + ':', sensor['value'], unit))
+        out = FbxRenderer()
+        FbxServiceSystem.render_system_info(out, resp.result)
+        out.flush()
         return True
 
+    @staticmethod
+    def render_system_info(out, info):
+        """Render the system info"""
+        out.line('Server info:')
+        out.line(' - Model:     {}'.format(info['model_info']['pretty_name']))
+        out.line(' - MAC:       {}'.format(info['mac']))
+        out.line(' - Firmware:  {}'.format(info['firmware_version']))
+        out.line(' - Uptime:    {}'.format(info['uptime']))
+        out.line(' - Sensors:')
+        for sensor in info['sensors']:
+            unit = '°C' if sensor['id'].startswith('temp_') else ''
+            out.line('   - {:20} {}{}'.format(sensor['name'] + ':', sensor['value'], unit))
+
 
 class FbxServiceConnection(FbxService):
     """Connection domain"""
@@ -643,27 +1591,34 @@ class FbxServiceConnection(FbxService):
         if self._conf.resp_as_json:
             return resp.whole_content
 
-        print('Ethernet info:')
-        print(' - Info:')
-        print('   - IPv4:   {}'.format(resp.result['ipv4']))
-        print('   - IPv6:   {}'.format(resp.result['ipv6']))
-        print('   - Media:  {}'.format(resp.result['media']))
-        print('   - State:  {}'.format(resp.result['state']))
-        print(' - Down:')
-        print(
+        out = FbxRenderer()
+        FbxServiceConnection.render_line_ethernet_info(out, resp.result)
+        out.flush()
+        return True
+
+    @staticmethod
+    def render_line_ethernet_info(out, info):
+        """Render the connection status and rates"""
+        out.line('Ethernet info:')
+        out.line(' - Info:')
+        out.line('   - IPv4:   {}'.format(info['ipv4']))
+        out.line('   - IPv6:   {}'.format(info['ipv6']))
+        out.line('   - Media:  {}'.format(info['media']))
+        out.line('   - State:  {}'.format(info['state']))
+        out.line(' - Down:')
+        out.line(
             '   - Bandwidth:     {}'
-            .format(FbxServiceConnection.rate_to_human_readable(resp.result['bandwidth_down'])))
-        print(
+            .format(FbxServiceConnection.rate_to_human_readable(info['bandwidth_down'])))
+        out.line(
             '   - Current rate:  {}'
-            .format(FbxServiceConnection.rate_to_human_readable(resp.result['rate_down'])))
-        print(' - Up:')
-        print(
+            .format(FbxServiceConnection.rate_to_human_readable(info['rate_down'])))
+        out.line(' - Up:')
+        out.line(
             '   - Bandwidth:     {}'
-            .format(FbxServiceConnection.rate_to_human_readable(resp.result['bandwidth_up'])))
-        print(
+            .format(FbxServiceConnection.rate_to_human_readable(info['bandwidth_up'])))
+        out.line(
             '   - Current rate:  {}'
-            .format(FbxServiceConnection.rate_to_human_readable(resp.result['rate_up'])))
-        return True
+            .format(FbxServiceConnection.rate_to_human_readable(info['rate_up'])))
 
     def get_line_media_info(self):
         """Retieve xDSL or FTTH info"""
@@ -683,26 +1638,26 @@ class FbxServiceConnection(FbxService):
         if self._conf.resp_as_json:
             return resp.whole_content
 
-        print('xDSL info:')
-        print(' - Status:')
-        for k, v in resp.result['status'].items():
-            print('   - {:13} {}'.format(k+':', v))
-        down = resp.result['down']
-        print(' - Down:')
-        print(
-            '   - Max Rate:     {}'
-            .format(FbxServiceConnection.rate_to_human_readable(down['rate']*1000)))
-        print('   - Attenuation:  {} dB'.format(down['attn_10']/10))
-        print('   - Noise magin:  {} dB'.format(down['snr_10']/10))
-        up = resp.result['up']
-        print(' - Up:')
-        print(
-            '   - Max Rate:     {}'
-            .format(FbxServiceConnection.rate_to_human_readable(up['rate']*1000)))
-        print('   - Attenuation:  {} dB'.format(up['attn_10']/10))
-        print('   - Noise magin:  {} dB'.format(up['snr_10']/10))
+        out = FbxRenderer()
+        FbxServiceConnection.render_xdsl_info(out, resp.result)
+        out.flush()
         return True
 
+    @staticmethod
+    def render_xdsl_info(out, info):
+        """Render the xDSL info"""
+        out.line('xDSL info:')
+        out.line(' - Status:')
+        for k, v in info['status'].items():
+            out.line('   - {:13} {}'.format(k+':', v))
+        for title, rates in ((' - Down:', info['down']), (' - Up:', info['up'])):
+            out.line(title)
+            out.line(
+                '   - Max Rate:     {}'
+                .format(FbxServiceConnection.rate_to_human_readable(rates['rate']*1000)))
+            out.line('   - Attenuation:  {} dB'.format(rates['attn_10']/10))
+            out.line('   - Noise magin:  {} dB'.format(rates['snr_10']/10))
+
     def _get_ftth_info(self):
         """Retrieve the FTTH info"""
         uri = '/connection/ftth'
@@ -711,26 +1666,33 @@ class FbxServiceConnection(FbxService):
         if self._conf.resp_as_json:
             return resp.whole_content
 
-        if resp.result['has_sfp'] != True and resp.result['sfp_present'] != True:
-            print('No SFP module detected')
+        out = FbxRenderer()
+        has_sfp = FbxServiceConnection.render_ftth_info(out, resp.result)
+        out.flush()
+        return has_sfp
+
+    @staticmethod
+    def render_ftth_info(out, info):
+        """Render the FTTH info, return whether a SFP module is present"""
+        if info['has_sfp'] != True and info['sfp_present'] != True:
+            out.line('No SFP module detected')
             return False
 
-        print('FTTH info:')
-        print(' - SPF Module:')
-        print('   - Model:     {}'.format(resp.result['sfp_model']))
-        print('   - Vendor     {}'.format(resp.result['sfp_vendor']))
-        print('   - Serial:    {}'.format(resp.result['sfp_serial']))
-        print(' - Status:')
-        print('   - Signal:    {}'.format(resp.result['sfp_has_signal']))
-        print('   - Alim:      {}'.format(resp.result['sfp_alim_ok']))
-        # print('   - Powered:   {}'.format(resp.result['sfp_has_power_report']))
-        if resp.result['link'] != True:
-            print('   - Link:      {}'.format(resp.result['link']))
+        out.line('FTTH info:')
+        out.line(' - SPF Module:')
+        out.line('   - Model:     {}'.format(info['sfp_model']))
+        out.line('   - Vendor     {}'.format(info['sfp_vendor']))
+        out.line('   - Serial:    {}'.format(info['sfp_serial']))
+        out.line(' - Status:')
+        out.line('   - Signal:    {}'.format(info['sfp_has_signal']))
+        out.line('   - Alim:      {}'.format(info['sfp_alim_ok']))
+        # out.line('   - Powered:   {}'.format(info['sfp_has_power_report']))
+        if info['link'] != True:
+            out.line('   - Link:      {}'.format(info['link']))
         else:
-            print(' - Link:')
-            print('   - Tx:  {} dB'.format(resp.result['sfp_pwr_tx']/100))
-            print('   - Rx:  {} dB'.format(resp.result['sfp_pwr_rx']/100))
-
+            out.line(' - Link:')
+            out.line('   - Tx:  {} dB'.format(info['sfp_pwr_tx']/100))
+            out.line('   - Rx:  {} dB'.format(info['sfp_pwr_rx']/100))
         return True
 
 
@@ -745,8 +1707,16 @@ class FbxServiceStorage(FbxService):
         if self._conf.resp_as_json:
             return resp.whole_content
 
-        print('Drives connected :')
-        for drive in resp.result:
+        out = FbxRenderer()
+        FbxServiceStorage.render_connected_drives(out, resp.result)
+        out.flush()
+        return True
+
+    @staticmethod
+    def render_connected_drives(out, drives):
+        """Render the drives spinning state"""
+        out.line('Drives connected :')
+        for drive in drives:
             model = drive['model']
             serial = drive['serial']
 
@@ -758,8 +1728,7 @@ class FbxServiceStorage(FbxService):
             temp = drive['temp']
             spinning = drive['spinning']
 
-            print(' - {} ({}) | temp: {} | spining: {}'.format(model, serial, temp, spinning))
-        return True
+            out.line(' - {} ({}) | temp: {} | spining: {}'.format(model, serial, temp, spinning))
 
     def get_storage_status(self):
         """Retrieve the storage partitions and spaces"""
@@ -769,13 +1738,21 @@ class FbxServiceStorage(FbxService):
         if self._conf.resp_as_json:
             return resp.whole_content
 
-        print('Storage info:')
-        for drive in resp.result:
+        out = FbxRenderer()
+        FbxServiceStorage.render_storage_status(out, resp.result)
+        out.flush()
+        return True
+
+    @staticmethod
+    def render_storage_status(out, drives):
+        """Render the storage partitions and spaces"""
+        out.line('Storage info:')
+        for drive in drives:
             model = drive['model']
             if model == '':
                 model = '_no_brand_'
 
-            print(' - {}'.format(model))
+            out.line(' - {}'.format(model))
             for part in drive['partitions']:
                 if part['total_bytes'] > pow(1024, 3):
                     total = part['total_bytes'] / pow(1024, 3)
@@ -788,15 +1765,318 @@ class FbxServiceStorage(FbxService):
                     used = part['used_bytes'] / pow(1024, 2)
                     unit = 'Mo'
                 free_percent = avail * 100 / total
-                print(
+                out.line(
                     '    #{:15s} :\t'.format(part['label']) +
                     'total: {value:4.0f}{unit} |'.format(value=total, unit=unit) +
                     ' used: {value:4.0f}{unit} |'.format(value=used, unit=unit) +
                     ' free: {value:4.0f}{unit}'.format(value=avail, unit=unit) +
                     ' ({value:.1f}{unit} free)'.format(value=free_percent, unit='%'))
 
+    def get_disk_usage(self, path, workers=4, full=False):
+        """Display the size of path and of its subdirectories
+
+        The directory tree is crawled with /fs/ls/ requests sent by a pool of
+        workers. Unless full is set, directories whose mtime did not change since
+        previous run are not listed again: their entries in the local index are
+        reused. A directory mtime only changes when entries are added, removed or
+        renamed in it. The mtime of a directory is the one seen when listing its
+        parent, or requested with /fs/info/ when its parent was not listed.
+        """
+        log('>>> get_disk_usage')
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+        path = '/' + path.strip('/')
+        index = FbxDirectoryIndex(self._conf.du_index_file)
+        old = index.load() if not full else {}
+        dirs = {}
+        listed = 0
+        errors = 0
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # (directory, mtime seen in a listing of its parent, None if unknown)
+            todo = [(path, None)]
+            pending = {}
+            while todo or pending:
+                while todo:
+                    dir_path, mtime = todo.pop()
+                    entry = old.get(dir_path)
+                    if entry is not None and mtime is not None and entry['mtime'] == mtime:
+                        # mtimes of subdirectories in the index may be outdated
+                        dirs[dir_path] = entry
+                        todo.extend((FbxDirectoryIndex.join(dir_path, name), None) for name in entry['dirs'])
+                    else:
+                        pending[pool.submit(self._scan_directory, dir_path, mtime, entry)] = dir_path
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dir_path = pending.pop(future)
+                    try:
+                        entry, is_listed = future.result()
+                    except FbxException as exc:
+                        if dir_path == path:
+                            raise
+                        # e.g. removed meanwhile: not indexed, listed again next time
+                        log('Unable to list {}: {}'.format(dir_path, exc))
+                        errors += 1
+                        continue
+                    dirs[dir_path] = entry
+                    if is_listed:
+                        listed += 1
+                        todo.extend((FbxDirectoryIndex.join(dir_path, name), child_mtime)
+                                    for name, child_mtime in entry['dirs'].items())
+                    else:
+                        todo.extend((FbxDirectoryIndex.join(dir_path, name), None) for name in entry['dirs'])
+
+        index.update(path, dirs)
+        sizes = FbxDirectoryIndex.total_sizes(dirs)
+        subdirs = sorted(
+            ((FbxDirectoryIndex.join(path, name), sizes.get(FbxDirectoryIndex.join(path, name), 0))
+             for name in dirs[path]['dirs']), key=lambda subdir: subdir[1], reverse=True)
+
+        if self._conf.resp_as_ndjson:
+            # a row per subdirectory then for path, as du does
+            return [{'path': subdir, 'size': size} for subdir, size in subdirs] + [
+                {'path': path, 'size': sizes[path]}]
+
+        usage = {
+            'path': path, 'size': sizes[path], 'dirs': dict(subdirs),
+            'listed': listed, 'reused': len(dirs) - listed, 'errors': errors}
+        if self._conf.resp_as_json:
+            return usage
+
+        out = FbxRenderer()
+        FbxServiceStorage.render_disk_usage(out, usage)
+        out.flush()
         return True
 
+    @staticmethod
+    def render_disk_usage(out, usage):
+        """Render the size of a directory tree and of its subdirectories"""
+        for subdir, size in usage['dirs'].items():
+            out.line('{:>10}  {}'.format(FbxServiceStorage.format_size(size), subdir))
+        out.line('{:>10}  {}'.format(FbxServiceStorage.format_size(usage['size']), usage['path']))
+        out.line('{} directories: {} listed, {} from index{}'.format(
+            usage['listed'] + usage['reused'], usage['listed'], usage['reused'],
+            ', {} not listable'.format(usage['errors']) if usage['errors'] else ''))
+
+    def _scan_directory(self, path, mtime, entry):
+        """Return the index entry of a directory, and whether it was listed
+
+        Its previous entry is reused if its mtime, requested when unknown, did
+        not change.
+        """
+        if mtime is None and entry is not None:
+            import base64
+            uri = '/fs/info/' + base64.b64encode(path.encode()).decode()
+            mtime = self.get_service_data(uri, cached=False).result.get('modification')
+            if entry['mtime'] == mtime:
+                return entry, False
+        return self._list_directory(path, mtime), True
+
+    def _list_directory(self, path, mtime):
+        """List a directory, return its index entry"""
+        import base64
+        uri = '/fs/ls/' + base64.b64encode(path.encode()).decode()
+        entry = {'mtime': mtime, 'size': 0, 'files': 0, 'dirs': {}}
+        for info in self.get_service_data(uri, cached=False).result or []:
+            name = info.get('name')
+            if name == '.':
+                entry['mtime'] = info.get('modification')
+            elif name == '..':
+                continue
+            elif info.get('type') == 'dir':
+                entry['dirs'][name] = info.get('modification')
+            else:
+                entry['size'] += info.get('size') or 0
+                entry['files'] += 1
+        return entry
+
+    # size of the chunks read and written by --fetch
+    FETCH_CHUNK_SIZE = 1024 * 1024
+    # minimum size of a segment in segmented mode
+    FETCH_MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+
+    def fetch_file(self, paths, segments=1):
+        """Download the remote file paths[0] of the storage into the local file paths[1]
+
+        The content is written by chunks into LOCAL.part, renamed LOCAL once its
+        size is checked. A partial LOCAL.part left by a previous run is resumed
+        with Range requests. With segments > 1, the remaining content is split
+        into ranges fetched concurrently over several connections; their
+        progress is saved in LOCAL.part.json to resume them.
+        """
+        log('>>> fetch_file')
+        import base64
+        remote, local = paths
+        remote = '/' + remote.strip('/')
+        b64_path = base64.b64encode(remote.encode()).decode()
+        info = self.get_service_data('/fs/info/' + b64_path, cached=False).result
+        if info.get('type') == 'dir':
+            raise FbxException('Not a file: {}'.format(remote))
+        size = info.get('size')
+        uri = '/dl/' + b64_path
+        part_file = local + '.part'
+        state_file = part_file + '.json'
+
+        # [start, end] bounds of the parts of the file, and ranges still to
+        # fetch in them, as [position, end] lists updated while writing
+        bounds = ranges = None
+        restart = False
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                state = json.load(f)
+            if FbxServiceStorage._resumable(state, size, part_file):
+                bounds = state['bounds']
+                ranges = [r for r in state['ranges'] if r[0] <= r[1]]
+            else:
+                # parts fetched may be missing from part_file: start over
+                log('Discarding fetch state {}'.format(state_file))
+                restart = True
+        if ranges is None:
+            have = os.path.getsize(part_file) if os.path.exists(part_file) and not restart else 0
+            if have > size:
+                have = 0
+            remaining = size - have
+            segments = max(1, min(segments, remaining // FbxServiceStorage.FETCH_MIN_SEGMENT_SIZE))
+            starts = [have + remaining * i // segments for i in range(segments + 1)]
+            ranges = [[starts[i], starts[i + 1] - 1] for i in range(segments) if starts[i] < starts[i + 1]]
+            bounds = ([[0, have - 1]] if have else []) + [list(r) for r in ranges]
+        resumed = size - sum(end - pos + 1 for pos, end in ranges)
+
+        start_time = time.monotonic()
+        fd = os.open(part_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size > size:
+                os.ftruncate(fd, size)
+            if len(ranges) > 1:
+                self._fetch_segments(uri, fd, bounds, ranges, state_file, size)
+            elif ranges:
+                self._fetch_range(uri, fd, ranges[0], allow_restart=True)
+        finally:
+            os.close(fd)
+        elapsed = time.monotonic() - start_time
+
+        if (os.path.getsize(part_file) != size or any(pos <= end for pos, end in ranges) or
+                not FbxServiceStorage._tiled(bounds, size)):
+            raise FbxException('Incomplete download of {}: {} bytes expected'.format(remote, size))
+        os.replace(part_file, local)
+        if os.path.exists(state_file):
+            os.remove(state_file)
+
+        fetched = {'remote': remote, 'local': local, 'size': size, 'resumed': resumed, 'elapsed': elapsed}
+        if self._conf.resp_as_json:
+            return fetched
+
+        out = FbxRenderer()
+        FbxServiceStorage.render_fetch(out, fetched)
+        out.flush()
+        return True
+
+    @staticmethod
+    def render_fetch(out, fetched):
+        """Render the outcome of a file download"""
+        size, resumed, elapsed = fetched['size'], fetched['resumed'], fetched['elapsed']
+        rate = (size - resumed) / elapsed if elapsed else 0
+        out.line('{} -> {}: {}{} in {:.1f}s ({}/s)'.format(
+            fetched['remote'], fetched['local'], FbxServiceStorage.format_size(size),
+            ' (resumed from {})'.format(FbxServiceStorage.format_size(resumed)) if resumed else '',
+            elapsed, FbxServiceStorage.format_size(rate)))
+
+    def _fetch_range(self, uri, fd, byte_range, allow_restart=False, progress=None):
+        """Fetch byte_range ([position, end]) of uri into fd, updating its position as it is written
+
+        If the range is not honoured, the whole content is written from the
+        start when allow_restart is set.
+        """
+        pos, end = byte_range
+        r = self._http.get_content(uri, pos, end)
+        with r:
+            if r.status_code != 206:
+                if not allow_restart:
+                    raise FbxException('Range requests not supported for {}'.format(uri))
+                if pos > 0:
+                    log('Range not honoured: fetching {} from start'.format(uri))
+                byte_range[0] = 0
+            for chunk in r.iter_content(FbxServiceStorage.FETCH_CHUNK_SIZE):
+                os.pwrite(fd, chunk, byte_range[0])
+                byte_range[0] += len(chunk)
+                if progress is not None:
+                    progress()
+
+    @staticmethod
+    def _tiled(bounds, size):
+        """Tell whether [start, end] bounds cover a file of size bytes, without overlapping"""
+        expected = 0
+        for start, end in sorted(bounds):
+            if start != expected or end < start:
+                return False
+            expected = end + 1
+        return expected == size
+
+    @staticmethod
+    def _resumable(state, size, part_file):
+        """Tell whether a fetch can be resumed from its saved state
+
+        Its bounds must cover the file, each range to fetch must be the end of
+        one of them, and part_file must hold what was already fetched.
+        """
+        bounds = state.get('bounds')
+        ranges = state.get('ranges')
+        if state.get('size') != size or bounds is None or ranges is None:
+            return False
+        if not FbxServiceStorage._tiled(bounds, size) or not os.path.exists(part_file):
+            return False
+        # bound end => position reached in it, bounds without range being complete
+        positions = {end: pos for pos, end in ranges}
+        if len(positions) != len(ranges):
+            return False
+        fetched = 0
+        for start, end in bounds:
+            pos = positions.pop(end, end + 1)
+            if not start <= pos <= end + 1:
+                return False
+            if pos > start:
+                fetched = max(fetched, pos)
+        return not positions and os.path.getsize(part_file) >= fetched
+
+    def _fetch_segments(self, uri, fd, bounds, ranges, state_file, size):
+        """Fetch ranges of uri into fd concurrently, saving their progress into state_file"""
+        from concurrent.futures import ThreadPoolExecutor
+        lock = threading.Lock()
+        written = [0]
+
+        def save_state():
+            with lock:
+                state = {'size': size, 'bounds': bounds, 'ranges': [list(r) for r in ranges]}
+            fd_tmp, tmp_path = tempfile.mkstemp(dir=os.path.dirname(state_file) or '.', suffix='.tmp')
+            with open(fd_tmp, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, state_file)
+
+        def progress():
+            # state is saved every 8 chunks written by any segment
+            with lock:
+                written[0] += 1
+                save = written[0] % 8 == 0
+            if save:
+                save_state()
+
+        save_state()
+        try:
+            with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+                futures = [pool.submit(self._fetch_range, uri, fd, r, False, progress) for r in ranges]
+                for future in futures:
+                    future.result()
+        finally:
+            save_state()
+
+    @staticmethod
+    def format_size(size):
+        """Return size in human readable format"""
+        for unit in ('o', 'Ko', 'Mo', 'Go'):
+            if size < 1024:
+                return '{:.1f}{}'.format(size, unit)
+            size /= 1024
+        return '{:.1f}To'.format(size)
+
 
 class FbxServiceWifi(FbxService):
     """Wifi domain"""
@@ -835,9 +2115,10 @@ class FbxServiceWifi(FbxService):
         timeout = 3 if not set_on else None
 
         # PUT
+        from requests.exceptions import Timeout
         try:
             resp = self._http.put(uri, data=data, timeout=timeout)
-        except requests.exceptions.Timeout as exc:
+        except Timeout as exc:
             if not set_on:
                 # If we are connected using wifi, disabling wifi will close connection
                 # thus PUT response will never be received: a timeout is expected
@@ -899,6 +2180,12 @@ class FbxServiceWifi(FbxService):
 class FbxServiceDhcp(FbxService):
     """DHCP domain"""
 
+    def __init__(self, http, conf):
+        """Constructor"""
+        super().__init__(http, conf)
+        # (response, index built from it)
+        self._lease_index = None
+
     def get_config(self):
         """Get the current DHCP config"""
         uri = '/dhcp/config/'
@@ -910,49 +2197,95 @@ class FbxServiceDhcp(FbxService):
         log(">>> get_dhcp_leases")
         # GET wifi status
         uri = '/dhcp/dynamic_lease/'
-        resp = self._http.get(uri)
 
-        if not resp.success:
-            raise FbxException('Request failure: {}'.format(resp))
+        # json lines format: leases are output while the response is received
+        if self._conf.resp_as_ndjson:
+            return self._http.iter_result(uri)
 
         # json response format
         if self._conf.resp_as_json:
-            return resp.whole_content
-
-        # human response format
-        leases = resp.result
-        if leases is None:
-            print('No DHCP leases')
-            return 0
+            return self.get_service_data(uri).whole_content
 
-        def display_lease_entry(count, lease):
-            print(
-                '  #{}: mac: {}, ip: {}, hostname: {}, static: {}'
-                .format(
-                    count, lease.get('mac'), lease.get('ip'),
-                    lease.get('hostname'), lease.get('is_static')))
+        # human response format: leases are rendered while the response is received
+        out = FbxRenderer()
+        FbxServiceDhcp.render_dhcp_leases(out, self._http.iter_result(uri))
+        out.flush()
+        return 0
 
-        count = 1
-        print('List of reachable leases:')
+    @staticmethod
+    def render_dhcp_leases(out, leases):
+        """Render leases by state, in a single pass over them"""
+        def lease_entry(count, lease):
+            return '  #{}: {}'.format(count, FbxServiceDhcp.format_lease(lease))
+
+        # reachable leases are rendered at once, only the lines of other ones
+        # are kept until the end
+        reachable = 0
+        unreachable = []
+        others = []
         for lease in leases:
-            if 'host' in lease and lease.get('host').get('reachable'):
-                display_lease_entry(count, lease)
-                count += 1
+            if not reachable and not unreachable and not others:
+                out.line('List of reachable leases:')
+            state = FbxLeaseIndex.state(lease)
+            if state == 'reachable':
+                reachable += 1
+                out.line(lease_entry(reachable, lease))
+            elif state == 'unreachable':
+                unreachable.append(lease_entry(len(unreachable) + 1, lease))
+            else:
+                others.append(lease_entry(len(others) + 1, lease))
 
-        count = 1
-        print('List of unreachable leases:')
-        for lease in leases:
-            if 'host' in lease and not lease.get('host').get('reachable'):
-                display_lease_entry(count, lease)
-                count += 1
+        if not reachable and not unreachable and not others:
+            out.line('No DHCP leases')
+            return
 
-        count = 1
-        print('List of other leases:')
-        for lease in leases:
-            if 'host' not in lease:
-                display_lease_entry(count, lease)
-                count += 1
-        return 0
+        out.line('List of unreachable leases:')
+        out.lines(unreachable)
+        out.line('List of other leases:')
+        out.lines(others)
+
+    @staticmethod
+    def format_lease(lease):
+        """ Return the display line of a lease """
+        return 'mac: {}, ip: {}, hostname: {}, static: {}'.format(
+            lease.get('mac'), lease.get('ip'), lease.get('hostname'), lease.get('is_static'))
+
+    def get_lease_index(self):
+        """ Return the index of the current leases
+
+        The index is only rebuilt when the leases response is not the cached one
+        it was built from anymore.
+        """
+        resp = self.get_service_data('/dhcp/dynamic_lease/')
+        lease_index = self._lease_index
+        if lease_index is None or lease_index[0] is not resp:
+            lease_index = (resp, FbxLeaseIndex(resp.result or []))
+            self._lease_index = lease_index
+        return lease_index[1]
+
+    def find_leases(self, keys):
+        """ Display the leases matching MAC addresses, IP addresses or hostnames """
+        log(">>> find_leases")
+        lease_index = self.get_lease_index()
+        found = {key: lease_index.find(key) for key in keys}
+
+        # json response format
+        if self._conf.resp_as_json:
+            return found
+
+        out = FbxRenderer()
+        FbxServiceDhcp.render_found_leases(out, found)
+        out.flush()
+        return any(found.values())
+
+    @staticmethod
+    def render_found_leases(out, found):
+        """Render the leases found by key"""
+        for key, leases in found.items():
+            if not leases:
+                out.line('{}: no lease'.format(key))
+            for lease in leases:
+                out.line('{}: {}, {}'.format(key, FbxServiceDhcp.format_lease(lease), FbxLeaseIndex.state(lease)))
 
 
 class FbxServicePortForwarding(FbxService):
@@ -961,6 +2294,11 @@ class FbxServicePortForwarding(FbxService):
     def get_port_forwardings(self):
         """ List the port forwarding on going"""
         uri = '/fw/redir/'
+
+        # json lines format: port forwardings are output while the response is received
+        if self._conf.resp_as_ndjson:
+            return self._http.iter_result(uri)
+
         resp = self._http.get(uri)
 
         if not resp.success:
@@ -971,28 +2309,29 @@ class FbxServicePortForwarding(FbxService):
             return resp.whole_content
 
         # human response format
-        pforwardings = resp.result
-        if pforwardings is None:
-            print('No port forwarding')
-            return 0
+        out = FbxRenderer()
+        FbxServicePortForwarding.render_port_forwardings(out, resp.result)
+        out.flush()
+        return 0
 
-        def display_port_forwarding_entry(count, pforwarding):
-            data = '  #{}: id: {}, enabled: {}, hostname: {}, comment: {},\n'
-            data += '       lan_port: {}, wan_port_start: {}, wan_port_end: {}\n'
-            data += '       src_ip: {}, lan_ip: {}, ip_proto: {}'
-            print(data.format(
+    @staticmethod
+    def render_port_forwardings(out, pforwardings):
+        """Render port forwardings"""
+        if pforwardings is None:
+            out.line('No port forwarding')
+            return
+
+        data = '  #{}: id: {}, enabled: {}, hostname: {}, comment: {},\n'
+        data += '       lan_port: {}, wan_port_start: {}, wan_port_end: {}\n'
+        data += '       src_ip: {}, lan_ip: {}, ip_proto: {}'
+        out.line('List of reachable leases:')
+        for count, pforwarding in enumerate(pforwardings, 1):
+            out.line(data.format(
                     count, pforwarding.get('id'), pforwarding.get('enabled'),
                     pforwarding.get('hostname'), pforwarding.get('comment'), pforwarding.get('lan_port'),
                     pforwarding.get('wan_port_start'), pforwarding.get('wan_port_end'),
                     pforwarding.get('src_ip'), pforwarding.get('lan_ip'), pforwarding.get('ip_proto')))
 
-        count = 1
-        print('List of reachable leases:')
-        for pforwarding in pforwardings:
-            display_port_forwarding_entry(count, pforwarding)
-            count += 1
-        return 0
-
 
 class FbxServiceCall(FbxService):
     """Call domain"""
@@ -1010,41 +2349,77 @@ class FbxServiceCall(FbxService):
     def _get_calls_list(self, new_only):
         """ List all the calls """
         uri = '/call/log/'
-        resp = self._http.get(uri)
 
-        if not resp.success:
-            raise FbxException('Request failure: {}'.format(resp))
+        # json lines format: calls are output while the response is received
+        if self._conf.resp_as_ndjson:
+            return (call for call in self._http.iter_result(uri) if not new_only or call.get('new') is not False)
 
         # json response format
         if self._conf.resp_as_json:
-            return resp.whole_content
+            return self.get_service_data(uri).whole_content
+
+        # calls are rendered while the response is received
+        calls = self._http.iter_result(uri)
+        if new_only:
+            calls = (call for call in calls if call.get('new') is not False)
+        out = FbxRenderer()
+        count = FbxServiceCall.render_calls(out, calls)
+        out.flush()
+        return count > 0
 
+    @staticmethod
+    def render_calls(out, calls):
+        """Render calls, return their number"""
         count = 0
-        calls = resp.result
         for call in calls:
-            # for new call only, we display new calls only
-            if new_only and call.get('new') is False:
-                continue
-
             count += 1
-            # call to be displayed
-            timestamp = call.get('datetime')
-            duration = call.get('duration')
-            number = call.get('number')
-            name = call.get('name')
-
-            strdate = datetime.fromtimestamp(
-                timestamp).strftime('%d-%m-%Y %H:%M:%S')
-            strdur = datetime.fromtimestamp(
-                duration).strftime('%M:%S')
-
-            status = call.get('type')
-            tag = '<' if status == 'outgoing'else '!' if status == 'missed' else '>'
-            naming = ' ({})'.format(name) if number != name else ''
-            dur = ' - {}'.format(strdur) if status != "missed" and duration else ''
-            print('{} {} {}{}{}'.format(strdate, tag, number, naming, dur))
+            out.line(FbxServiceCall.format_call(call))
+        return count
 
-        return count > 0
+    @staticmethod
+    def format_call(call):
+        """ Return the display line of a call """
+        timestamp = call.get('datetime')
+        duration = call.get('duration')
+        number = call.get('number')
+        name = call.get('name')
+
+        strdate = datetime.fromtimestamp(
+            timestamp).strftime('%d-%m-%Y %H:%M:%S')
+        strdur = datetime.fromtimestamp(
+            duration).strftime('%M:%S')
+
+        status = call.get('type')
+        tag = '<' if status == 'outgoing'else '!' if status == 'missed' else '>'
+        naming = ' ({})'.format(name) if number != name else ''
+        dur = ' - {}'.format(strdur) if status != "missed" and duration else ''
+        return '{} {} {}{}{}'.format(strdate, tag, number, naming, dur)
+
+    def sync_calls(self):
+        """ Store the calls received since last sync into the local call log """
+        log(">>> sync_calls")
+        count = FbxCallLog(self._conf.calls_db).sync(self._http.iter_result('/call/log/'))
+
+        if self._conf.resp_as_json:
+            return {'synced': count}
+
+        print('{} new call(s) stored'.format(count))
+        return RC_OK
+
+    def query_calls(self, since=None, number=None, call_type=None):
+        """ List the calls of the local call log, without any request """
+        log(">>> query_calls")
+        calls = FbxCallLog(self._conf.calls_db).query(since, number, call_type)
+        for call in calls:
+            call['new'] = bool(call['new'])
+
+        if self._conf.resp_as_json:
+            return calls
+
+        out = FbxRenderer()
+        FbxServiceCall.render_calls(out, calls)
+        out.flush()
+        return len(calls) > 0
 
     def mark_calls_as_read(self):
         """ Mark all the calls as read """
@@ -1067,56 +2442,953 @@ class FbxServiceCall(FbxService):
 class FbxServiceDownload(FbxService):
     """Download domain"""
 
-    def get_downloads_list(self):
-        """ List downloads """
+    # download statuses reported by FreeboxOS
+    STATUSES = (
+        'stopped', 'queued', 'starting', 'downloading', 'stopping', 'error', 'done',
+        'checking', 'repairing', 'extracting', 'seeding', 'retry')
+
+    # download type => displayed section, in display order
+    TYPES = {'bt': 'Torrents', 'http': 'HTTPs', 'ftp': 'FTPs', 'nzb': 'NewsGp'}
+
+    @staticmethod
+    def select(downloads, status=None, offset=None, limit=None):
+        """ Return an iterator on the downloads with the given status, skipping the offset first ones, up to limit """
+        import itertools
+        if status is not None:
+            downloads = (data for data in downloads if data.get('status') == status)
+        offset = offset or 0
+        return itertools.islice(downloads, offset, None if limit is None else offset + limit)
+
+    def get_downloads_list(self, status=None, offset=None, limit=None):
+        """ List downloads, optionally filtered by status and paged """
         uri = '/downloads/'
-        resp = self._http.get(uri)
 
-        if not resp.success:
-            raise FbxException('Request failure: {}'.format(resp))
+        # json lines format: downloads are output while the response is received
+        if self._conf.resp_as_ndjson:
+            return FbxServiceDownload.select(self._http.iter_result(uri), status, offset, limit)
 
         # json response format
         if self._conf.resp_as_json:
-            return resp.whole_content
+            resp = self.get_service_data(uri).whole_content
+            if status is not None or offset or limit is not None:
+                downloads = FbxServiceDownload.select(resp.get('result') or [], status, offset, limit)
+                resp = dict(resp, result=list(downloads))
+            return resp
+
+        # downloads are rendered while the response is received, whose
+        # reception stops once limit is reached
+        out = FbxRenderer()
+        count = FbxServiceDownload.render_downloads(
+            out, FbxServiceDownload.select(self._http.iter_result(uri), status, offset, limit))
+        out.flush()
+        return count > 0
 
-        count = 0
-        dls = resp.result
-        if dls:
-            dl = {}
-            dl['Torrents'] = [x for x in dls if x.get('type') == 'bt']
-            dl['HTTPs'] = [x for x in dls if x.get('type') == 'http']
-            dl['FTPs'] = [x for x in dls if x.get('type') == 'ftp']
-            dl['NewsGp'] = [x for x in dls if x.get('type') == 'nzb']
-            for dl_type in ['Torrents', 'HTTPs', 'FTPs', 'NewsGp']:
-                nb = 0
-                if len(dl[dl_type]):
-                    for data in dl[dl_type]:
-                        nb += 1
-                        eta = timedelta(seconds=data.get('eta')).__str__()
-                        rx_rate = data.get('rx_rate')
-                        if rx_rate > 1000000:
-                            rx_rate /= 1000000
-                            rx_unit = 'Mo/s'
-                        elif rx_rate > 1000:
-                            rx_rate /= 1000
-                            rx_unit = 'Ko/s'
-                        else:
-                            rx_unit = 'o/s'
-                        completion = data.get('rx_bytes') * 100 / data.get('size')
-                        print('{}:'.format(dl_type))
-                        print(
-                            '  #{}: name: {} |'.format(nb, data.get('name')) +
-                            ' tx_bytes: {} |'.format(data.get('tx_bytes')) +
-                            ' rx_bytes: {} ({:.1f}%) |'.format(data.get('rx_bytes'), completion) +
-                            ' rx_rate: {:.1f}{} |'.format(rx_rate, rx_unit) +
-                            ' ETA: {}'.format(eta))
-                else:
-                    print('{}:\t--'.format(dl_type))
-                count += nb
+    @staticmethod
+    def render_downloads(out, downloads):
+        """Render downloads by type, in a single pass over them, return their number
+
+        Torrents are rendered at once, lines of other types are kept to be
+        rendered after them.
+        """
+        sections = list(FbxServiceDownload.TYPES.values())
+        counts = {dl_type: 0 for dl_type in sections}
+        lines = {dl_type: [] for dl_type in sections[1:]}
+        for data in downloads:
+            dl_type = FbxServiceDownload.TYPES.get(data.get('type'))
+            if dl_type is None:
+                continue
+            counts[dl_type] += 1
+            eta = timedelta(seconds=data.get('eta')).__str__()
+            rx_rate = data.get('rx_rate')
+            if rx_rate > 1000000:
+                rx_rate /= 1000000
+                rx_unit = 'Mo/s'
+            elif rx_rate > 1000:
+                rx_rate /= 1000
+                rx_unit = 'Ko/s'
+            else:
+                rx_unit = 'o/s'
+            size = data.get('size')
+            # size is 0 while unknown (e.g. HTTP downloads without length)
+            completion = '{:.1f}%'.format(data.get('rx_bytes') * 100 / size) if size else '?'
+            line = '{}:\n  #{}: name: {} | tx_bytes: {} | rx_bytes: {} ({}) | rx_rate: {:.1f}{} | ETA: {}'.format(
+                dl_type, counts[dl_type], data.get('name'), data.get('tx_bytes'), data.get('rx_bytes'),
+                completion, rx_rate, rx_unit, eta)
+            if dl_type == sections[0]:
+                out.line(line)
+            else:
+                lines[dl_type].append(line)
+
+        count = sum(counts.values())
+        if not count:
+            out.line('No download currently.')
+            return 0
+
+        if not counts[sections[0]]:
+            out.line('{}:\t--'.format(sections[0]))
+        for dl_type, dl_lines in lines.items():
+            out.lines(dl_lines)
+            if not dl_lines:
+                out.line('{}:\t--'.format(dl_type))
+        return count
+
+    def add_downloads(self, source, workers=4, rate=None):
+        """ Add the downloads of the URLs (or magnet links) read from source, one per line
+
+        source is a file name, '-' for stdin. Downloads are submitted by a pool of
+        workers sharing the session, at most rate per second, and results are
+        displayed as they come.
+        """
+        log(">>> add_downloads")
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+        limiter = FbxRateLimiter(rate)
+
+        def add(line_nb, url):
+            limiter.wait()
+            res = {'line': line_nb, 'url': url}
+            try:
+                resp = self._http.post('/downloads/add', {'download_url': url}, form=True)
+            except (FbxException, OSError) as exc:
+                return dict(res, success=False, error=str(exc))
+            if not resp.success:
+                return dict(res, success=False, error=resp.error_msg)
+            return dict(res, success=True, id=(resp.result or {}).get('id'))
+
+        results = []
+        out = FbxRenderer()
+
+        def report(futures):
+            # progress is written once per batch of completed URLs
+            done = [future.result() for future in futures]
+            results.extend(done)
+            if not self._conf.resp_as_json:
+                FbxServiceDownload.render_added_downloads(out, done)
+                out.flush()
+
+        # the number of URLs read ahead is bounded, whatever the source size
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = set()
+            for line_nb, url in FbxServiceDownload._read_urls(source):
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    report(done)
+                pending.add(pool.submit(add, line_nb, url))
+            report(wait(pending).done)
+
+        if self._conf.resp_as_json:
+            return sorted(results, key=lambda res: res['line'])
+
+        failed = sum(1 for res in results if not res['success'])
+        out.line('{} download(s) added, {} failure(s)'.format(len(results) - failed, failed))
+        out.flush()
+        return failed == 0
+
+    @staticmethod
+    def render_added_downloads(out, results):
+        """Render the outcome of download submissions"""
+        for res in results:
+            if res['success']:
+                out.line('#{}: added (id: {}): {}'.format(res['line'], res['id'], res['url']))
+            else:
+                out.line('#{}: failed ({}): {}'.format(res['line'], res['error'], res['url']))
+
+    @staticmethod
+    def _read_urls(source):
+        """ Yield (line number, URL) of source, skipping empty and comment lines """
+        f = sys.stdin if source == '-' else open(source)
+        try:
+            for line_nb, line in enumerate(f, 1):
+                url = line.strip()
+                if url and not url.startswith('#'):
+                    yield line_nb, url
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+
+class FbxServiceRrd(FbxService):
+    """RRD (history) domain"""
+
+    # databases available on Freebox Server
+    DATABASES = ('net', 'temp', 'dsl', 'switch')
+
+    def get_rrd(self, db, date_start, date_end, fields=None, chunk=6 * 3600):
+        """Fetch db history between the given timestamps, chunk seconds at a time
+
+        The box may return less points than requested for a chunk: next chunk
+        then starts right after the last point received.
+        """
+        log('>>> get_rrd {} {}-{}'.format(db, date_start, date_end))
+        if db not in FbxServiceRrd.DATABASES:
+            raise FbxException('Unknown RRD database: {}'.format(db))
+
+        series = None
+        start = date_start
+        while start < date_end:
+            end = min(start + chunk, date_end)
+            data = {'db': db, 'date_start': start, 'date_end': end}
+            if fields:
+                data['fields'] = ['time'] + list(fields)
+            resp = self._http.post('/rrd/', data)
+            if not resp.success:
+                raise FbxException('Request failure: {}'.format(resp))
+
+            points = (resp.result or {}).get('data') or []
+            if series is None and points:
+                series = FbxRrdSeries(db, fields or sorted(k for k in points[0] if k != 'time'))
+            if series is not None:
+                series.append_points(points)
+
+            last = points[-1].get('time', end) if points else end
+            start = last + 1 if start < last < end else end
+
+        return series if series is not None else FbxRrdSeries(db, fields or [])
+
+    def export_rrd(self, db, period=86400, step=None, out=None, fields=None):
+        """Export db history of the last period seconds as CSV (or Parquet for .parquet files)
+
+        Without out file, points are output as CSV, or as JSON (one object per
+        point) in JSON mode.
+        """
+        now = int(time.time())
+        series = self.get_rrd(db, now - period, now, fields)
+        if step:
+            series = series.downsample(step)
+
+        if out is not None and out.endswith('.parquet'):
+            series.to_parquet(out)
+        elif out is not None:
+            with open(out, 'w', newline='') as of:
+                series.to_csv(of)
+        elif self._conf.resp_as_ndjson:
+            return series.rows()
+        elif self._conf.resp_as_json:
+            return list(series.rows())
         else:
-            print('No download currently.')
+            series.to_csv(sys.stdout)
 
-        return count > 0
+        if self._conf.resp_as_json:
+            return {'db': db, 'out': out, 'points': len(series)}
+        return len(series) > 0
+
+
+class FbxServiceTimeSeries(FbxService):
+    """Local time-series store of sampled metrics"""
+
+    def __init__(self, http, conf):
+        """Constructor"""
+        super().__init__(http, conf)
+        self._store = FbxTimeSeriesStore(conf.tsdb_dir)
+
+    @property
+    def store(self):
+        return self._store
+
+    def record_result(self, uri, result, t=None):
+        """Store the metrics of an endpoint result sampled at time t"""
+        if t is None:
+            t = time.time()
+        for metric, value in FbxServiceTimeSeries.extract_metrics(uri, result):
+            self._store.append(metric, t, value)
+
+    @staticmethod
+    def extract_metrics(uri, result):
+        """Yield (metric, value) of the sampled fields of an endpoint result"""
+        if uri == '/connection':
+            for field in ('rate_down', 'rate_up', 'bandwidth_down', 'bandwidth_up', 'bytes_down', 'bytes_up'):
+                if result.get(field) is not None:
+                    yield 'connection.' + field, result[field]
+        elif uri == '/system':
+            for sensor in result.get('sensors', []) + result.get('fans', []):
+                if sensor.get('value') is not None:
+                    yield 'system.' + sensor['id'], sensor['value']
+            if result.get('fan_rpm') is not None:
+                yield 'system.fan_rpm', result['fan_rpm']
+        elif uri == '/storage/disk/':
+            for drive in result or []:
+                for part in drive.get('partitions', []):
+                    for field in ('used_bytes', 'free_bytes'):
+                        yield 'storage.{}.{}'.format(part.get('label') or part.get('id'), field), part[field]
+
+    def record(self):
+        """Sample connection, system and storage metrics into the store"""
+        log('>>> record')
+        for uri in ('/connection', '/system', '/storage/disk/'):
+            self.record_result(uri, self.get_service_data(uri, cached=False).result)
+        return RC_OK
+
+    def query(self, pattern, period=86400):
+        """Display count/min/max/avg of metrics matching pattern over the last period seconds"""
+        import fnmatch
+        now = time.time()
+        metrics = [m for m in self._store.metrics() if fnmatch.fnmatchcase(m, pattern)]
+        rollups = [self._store.rollup(metric, now - period, now) for metric in metrics]
+
+        if self._conf.resp_as_json:
+            return rollups
+
+        out = FbxRenderer()
+        if not rollups:
+            out.line('No metric matching: {}'.format(pattern))
+        FbxServiceTimeSeries.render_rollups(out, rollups)
+        out.flush()
+        return len(rollups) > 0
+
+    @staticmethod
+    def render_rollups(out, rollups):
+        """Render count/min/max/avg of each metric"""
+        for r in rollups:
+            if r['count']:
+                out.line('{}: count: {} | min: {:g} | max: {:g} | avg: {:g}'.format(
+                    r['metric'], r['count'], r['min'], r['max'], r['avg']))
+            else:
+                out.line('{}: no sample'.format(r['metric']))
+
+
+class FbxRrdSeries:
+    """Time series fetched from RRD databases, stored in compact typed arrays
+
+    Timestamps and each field are stored in array.array (8 bytes per sample)
+    rather than in lists of dicts. NumPy is used, when available, to convert
+    and downsample them.
+    """
+
+    def __init__(self, db, fields):
+        """Constructor"""
+        import array
+        self._db = db
+        self._fields = list(fields)
+        self._times = array.array('q')
+        self._values = {field: array.array('d') for field in self._fields}
+
+    @property
+    def db(self):
+        return self._db
+
+    @property
+    def fields(self):
+        return self._fields
+
+    @property
+    def times(self):
+        return self._times
+
+    def values(self, field):
+        return self._values[field]
+
+    def __len__(self):
+        return len(self._times)
+
+    def append_points(self, points):
+        """Append RRD points (dicts with 'time' and field values), keeping time order"""
+        last = self._times[-1] if self._times else None
+        nan = float('nan')
+        for point in points:
+            t = point.get('time')
+            if t is None or (last is not None and t <= last):
+                # skip overlapping points of contiguous chunks
+                continue
+            last = t
+            self._times.append(t)
+            for field in self._fields:
+                value = point.get(field)
+                self._values[field].append(nan if value is None else value)
+
+    def as_numpy(self):
+        """Return (times, {field: values}) as NumPy arrays, without copying data"""
+        import numpy
+        times = numpy.frombuffer(self._times, dtype=numpy.int64)
+        return times, {f: numpy.frombuffer(v, dtype=numpy.float64) for f, v in self._values.items()}
+
+    def downsample(self, step):
+        """Return a new series averaging samples over step-second buckets"""
+        res = FbxRrdSeries(self._db, self._fields)
+        if not self._times:
+            return res
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+        if numpy is not None:
+            times, values = self.as_numpy()
+            buckets = times // step
+            # times are sorted: each bucket is a contiguous slice
+            starts = numpy.flatnonzero(numpy.r_[True, buckets[1:] != buckets[:-1]])
+            res._times.frombytes((buckets[starts] * step).astype(numpy.int64).tobytes())
+            for field in self._fields:
+                col = values[field]
+                valid = ~numpy.isnan(col)
+                sums = numpy.add.reduceat(numpy.where(valid, col, 0.0), starts)
+                nb = numpy.add.reduceat(valid.astype(numpy.int64), starts)
+                with numpy.errstate(invalid='ignore', divide='ignore'):
+                    res._values[field].frombytes((sums / nb).astype(numpy.float64).tobytes())
+            return res
+
+        bucket_start = None
+        acc = None
+        for i, t in enumerate(self._times):
+            bucket = t // step * step
+            if bucket != bucket_start:
+                if bucket_start is not None:
+                    res._flush_bucket(bucket_start, acc)
+                bucket_start = bucket
+                acc = {field: [0.0, 0] for field in self._fields}
+            for field in self._fields:
+                value = self._values[field][i]
+                if value == value:
+                    acc[field][0] += value
+                    acc[field][1] += 1
+        res._flush_bucket(bucket_start, acc)
+        return res
+
+    def _flush_bucket(self, bucket_start, acc):
+        self._times.append(bucket_start)
+        for field in self._fields:
+            total, nb = acc[field]
+            self._values[field].append(total / nb if nb else float('nan'))
+
+    def rows(self):
+        """Yield the series as {'time': t, field: value} dicts, missing values being None"""
+        columns = [(field, self._values[field]) for field in self._fields]
+        for i, t in enumerate(self._times):
+            row = {'time': t}
+            for field, col in columns:
+                row[field] = None if col[i] != col[i] else col[i]
+            yield row
+
+    def to_csv(self, stream):
+        """Write the series as CSV, one row per timestamp"""
+        import csv
+        writer = csv.writer(stream)
+        writer.writerow(['time'] + self._fields)
+        columns = [self._values[field] for field in self._fields]
+        for i, t in enumerate(self._times):
+            writer.writerow([t] + ['' if col[i] != col[i] else col[i] for col in columns])
+
+    def to_parquet(self, path):
+        """Write the series as a Parquet file (requires pyarrow)"""
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise FbxException('Package pyarrow is required for Parquet export')
+        columns = {'time': pyarrow.array(self._times, type=pyarrow.int64())}
+        for field in self._fields:
+            columns[field] = pyarrow.array(self._values[field], type=pyarrow.float64())
+        pyarrow.parquet.write_table(pyarrow.table(columns), path)
+
+
+class FbxTimeSeriesStore:
+    """Local time-series store: one fixed-size ring buffer file per metric
+
+    Each file holds a header and 'capacity' (time, value) records of two doubles,
+    the oldest records being overwritten once the buffer is full. Files are
+    memory-mapped: queries binary-search the time range and compute rollups
+    directly on the mapped records (with NumPy when available), without loading
+    the whole history into Python objects.
+    """
+
+    MAGIC = b'FBXRING1'
+    # magic, capacity, index of next record to write, number of records
+    HEADER = struct.Struct('<8sQQQ')
+    RECORD = struct.Struct('<dd')
+
+    def __init__(self, directory, capacity=100000):
+        """Constructor"""
+        self._dir = directory
+        self._capacity = capacity
+
+    def _path(self, metric):
+        name = ''.join(c if c.isalnum() or c in '._-' else '_' for c in metric)
+        return os.path.join(self._dir, name + '.ring')
+
+    def metrics(self):
+        """Return the names of the stored metrics"""
+        if not os.path.isdir(self._dir):
+            return []
+        return sorted(name[:-len('.ring')] for name in os.listdir(self._dir) if name.endswith('.ring'))
+
+    def append(self, metric, t, value):
+        """Append a sample to metric, creating its ring buffer if needed"""
+        import fcntl
+        import mmap
+        os.makedirs(self._dir, exist_ok=True)
+        path = self._path(metric)
+        with open(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b') as f:
+            # several recorders may run at once
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if os.fstat(f.fileno()).st_size == 0:
+                f.truncate(self.HEADER.size + self._capacity * self.RECORD.size)
+                f.seek(0)
+                f.write(self.HEADER.pack(self.MAGIC, self._capacity, 0, 0))
+                f.flush()
+            with mmap.mmap(f.fileno(), 0) as mm:
+                magic, capacity, head, count = self.HEADER.unpack_from(mm, 0)
+                if magic != self.MAGIC:
+                    raise FbxException('Not a time-series file: {}'.format(path))
+                self.RECORD.pack_into(mm, self.HEADER.size + head * self.RECORD.size, t, value)
+                self.HEADER.pack_into(mm, 0, magic, capacity, (head + 1) % capacity, min(count + 1, capacity))
+
+    def _open(self, metric):
+        """Return (mmap, capacity, head, count) of metric, None if not stored"""
+        import mmap
+        path = self._path(metric)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, capacity, head, count = self.HEADER.unpack_from(mm, 0)
+        if magic != self.MAGIC:
+            mm.close()
+            raise FbxException('Not a time-series file: {}'.format(path))
+        return mm, capacity, head, count
+
+    @staticmethod
+    def _bisect(records, lo, hi, t, after=False):
+        """Return first index in [lo, hi) whose time is >= t (> t if after is set)
+
+        records is the flat view of (time, value) doubles.
+        """
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if records[2 * mid] < t or (after and records[2 * mid] == t):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _segments(self, records, capacity, head, count, start, end):
+        """Return the [lo, hi) record index ranges, in time order, within [start, end]"""
+        if count < capacity:
+            parts = [(0, count)]
+        else:
+            # oldest records are after head
+            parts = [(head, capacity), (0, head)]
+        segments = []
+        for lo, hi in parts:
+            first = self._bisect(records, lo, hi, start)
+            last = self._bisect(records, first, hi, end, after=True)
+            if first < last:
+                segments.append((first, last))
+        return segments
+
+    def query(self, metric, start, end):
+        """Return (times, values) arrays of the samples within [start, end]"""
+        import array
+        times = array.array('d')
+        values = array.array('d')
+        opened = self._open(metric)
+        if opened is None:
+            return times, values
+        mm, capacity, head, count = opened
+        with mm:
+            records = memoryview(mm)[self.HEADER.size:].cast('d')
+            for lo, hi in self._segments(records, capacity, head, count, start, end):
+                chunk = records[2 * lo:2 * hi]
+                times.extend(chunk[0::2])
+                values.extend(chunk[1::2])
+                del chunk
+            records.release()
+        return times, values
+
+    def rollup(self, metric, start, end):
+        """Return count/min/max/avg of the samples within [start, end]"""
+        res = {'metric': metric, 'count': 0, 'min': None, 'max': None, 'avg': None}
+        opened = self._open(metric)
+        if opened is None:
+            return res
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+        mm, capacity, head, count = opened
+        with mm:
+            records = memoryview(mm)[self.HEADER.size:].cast('d')
+            total = 0.0
+            for lo, hi in self._segments(records, capacity, head, count, start, end):
+                if numpy is not None:
+                    values = numpy.frombuffer(records, dtype=numpy.float64, count=2 * hi, offset=0)[2 * lo + 1::2]
+                    low, high, part = float(values.min()), float(values.max()), float(values.sum())
+                    del values
+                else:
+                    low = high = records[2 * lo + 1]
+                    part = 0.0
+                    for i in range(lo, hi):
+                        value = records[2 * i + 1]
+                        part += value
+                        if value < low:
+                            low = value
+                        elif value > high:
+                            high = value
+                res['count'] += hi - lo
+                res['min'] = low if res['min'] is None else min(res['min'], low)
+                res['max'] = high if res['max'] is None else max(res['max'], high)
+                total += part
+            records.release()
+        if res['count']:
+            res['avg'] = total / res['count']
+        return res
+
+
+class FbxCallLog:
+    """Local call log database (SQLite), indexed by id, datetime and number
+
+    FreeboxOS call ids are increasing: the greatest stored id is the high-water
+    mark. Calls being listed most recent first, the listing is only walked
+    down to the stored calls.
+    """
+
+    FIELDS = ('id', 'datetime', 'type', 'number', 'name', 'duration', 'new', 'contact_id', 'line_id')
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS calls ('
+        'id INTEGER PRIMARY KEY, datetime INTEGER NOT NULL, type TEXT, number TEXT,'
+        ' name TEXT, duration INTEGER, new INTEGER, contact_id INTEGER, line_id INTEGER)',
+        'CREATE INDEX IF NOT EXISTS calls_datetime ON calls (datetime)',
+        'CREATE INDEX IF NOT EXISTS calls_number ON calls (number, datetime)',
+    )
+
+    def __init__(self, path):
+        """Constructor"""
+        self._path = path
+
+    def _connect(self):
+        import sqlite3
+        db = sqlite3.connect(self._path)
+        db.row_factory = sqlite3.Row
+        for statement in self.SCHEMA:
+            db.execute(statement)
+        return db
+
+    def sync(self, calls):
+        """Store the calls newer than the high-water mark, return the number stored
+
+        calls are read most recent first, up to the first stored call that is
+        not new anymore. The new flag of stored calls is reset, but for the
+        ones read meanwhile which are still new.
+        """
+        db = self._connect()
+        try:
+            with db:
+                mark = db.execute('SELECT MAX(id) FROM calls').fetchone()[0] or 0
+                rows = []
+                still_new = []
+                for call in calls:
+                    if call['id'] > mark:
+                        rows.append(tuple(call.get(field) for field in self.FIELDS))
+                    elif call.get('new'):
+                        still_new.append((call['id'],))
+                    else:
+                        break
+                db.execute('UPDATE calls SET new = 0 WHERE new')
+                db.executemany('UPDATE calls SET new = 1 WHERE id = ?', still_new)
+                db.executemany('INSERT OR REPLACE INTO calls ({}) VALUES ({})'.format(
+                    ', '.join(self.FIELDS), ', '.join('?' * len(self.FIELDS))), rows)
+        finally:
+            db.close()
+        return len(rows)
+
+    def query(self, since=None, number=None, call_type=None):
+        """Return the stored calls matching all given criteria, most recent first"""
+        if not os.path.exists(self._path):
+            return []
+        clauses, params = [], []
+        if since is not None:
+            clauses.append('datetime >= ?')
+            params.append(since)
+        if number is not None:
+            clauses.append('number = ?')
+            params.append(number)
+        if call_type is not None:
+            clauses.append('type = ?')
+            params.append(call_type)
+        sql = 'SELECT * FROM calls'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY datetime DESC, id DESC'
+        db = self._connect()
+        try:
+            return [dict(row) for row in db.execute(sql, params)]
+        finally:
+            db.close()
+
+
+class FbxLeaseIndex:
+    """DHCP leases indexed by MAC address, IP address and hostname
+
+    The index is built in a single pass over the leases. Lookups are case
+    insensitive, and MAC addresses may be given with '-' separators.
+    """
+
+    def __init__(self, leases):
+        """Constructor"""
+        self._leases = {}
+        for lease in leases:
+            keys = {FbxLeaseIndex._key(lease.get(field)) for field in ('mac', 'ip', 'hostname')}
+            for key in keys - {None}:
+                self._leases.setdefault(key, []).append(lease)
+
+    @staticmethod
+    def _key(value):
+        return value.strip().lower().replace('-', ':') if value else None
+
+    def find(self, key):
+        """Return the leases whose MAC address, IP address or hostname is key"""
+        return self._leases.get(FbxLeaseIndex._key(key), [])
+
+    @staticmethod
+    def state(lease):
+        """Return 'reachable' or 'unreachable' according to the lease host, 'unknown' if none"""
+        if 'host' not in lease:
+            return 'unknown'
+        return 'reachable' if lease.get('host').get('reachable') else 'unreachable'
+
+
+class FbxLeaseChanges:
+    """Changes of the DHCP leases between successive snapshots
+
+    Only the tracked fields (IP address, reachability) and hostname of each
+    lease are kept from a snapshot to the next one, keyed by MAC address:
+    leases whose tracked fields did not change are skipped.
+    """
+
+    def __init__(self):
+        """Constructor"""
+        # mac => (ip, state, hostname) of previous snapshot
+        self._snapshot = {}
+
+    def update(self, leases):
+        """Take a new snapshot, return the change events since the previous one
+
+        Events are 'join', 'leave', 'ip_change' and 'reachability', the first
+        snapshot reporting all leases as joining.
+        """
+        events = []
+        snapshot = {}
+        for lease in leases:
+            mac = (lease.get('mac') or '').lower()
+            ip = lease.get('ip')
+            state = FbxLeaseIndex.state(lease)
+            hostname = lease.get('hostname')
+            snapshot[mac] = (ip, state, hostname)
+            previous = self._snapshot.get(mac)
+            if previous is not None and previous[:2] == (ip, state):
+                continue
+            event = {'mac': mac, 'ip': ip, 'hostname': hostname}
+            if previous is None:
+                events.append(dict(event, event='join', state=state))
+                continue
+            if previous[0] != ip:
+                events.append(dict(event, event='ip_change', old_ip=previous[0]))
+            if previous[1] != state:
+                events.append(dict(event, event='reachability', state=state, old_state=previous[1]))
+        for mac, previous in self._snapshot.items():
+            if mac not in snapshot:
+                events.append({'mac': mac, 'ip': previous[0], 'hostname': previous[2], 'event': 'leave'})
+        self._snapshot = snapshot
+        return events
+
+
+class FbxDirectoryIndex:
+    """Local index of the directories of the Freebox Server storage
+
+    The index is a JSON file holding, per directory path, its mtime, the size
+    and number of its files, and the mtime of its subdirectories by name.
+    """
+
+    def __init__(self, path):
+        """Constructor"""
+        self._path = path
+        self._dirs = {}
+
+    @staticmethod
+    def join(dir_path, name):
+        return dir_path.rstrip('/') + '/' + name
+
+    def load(self):
+        """Load the index, return its directory entries by path"""
+        try:
+            with open(self._path) as f:
+                self._dirs = json.load(f)
+        except FileNotFoundError:
+            self._dirs = {}
+        except ValueError:
+            log('Ignoring corrupted directory index')
+            self._dirs = {}
+        return self._dirs
+
+    def update(self, path, dirs):
+        """Replace the entries of the tree rooted at path by dirs and save the index"""
+        prefix = path.rstrip('/') + '/'
+        entries = {p: e for p, e in self._dirs.items() if p != path and not p.startswith(prefix)}
+        entries.update(dirs)
+        self._dirs = entries
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self._path) or '.', suffix='.tmp')
+        with open(fd, 'w') as of:
+            json.dump(entries, of, separators=(',', ':'))
+        os.replace(tmp_path, self._path)
+
+    @staticmethod
+    def total_sizes(dirs):
+        """Return the total size of the files of each directory tree, by path"""
+        sizes = {}
+        # deepest directories first, so that subdirectories are summed before their parent
+        for path in sorted(dirs, key=lambda p: p.rstrip('/').count('/'), reverse=True):
+            entry = dirs[path]
+            sizes[path] = entry['size'] + sum(
+                sizes.get(FbxDirectoryIndex.join(path, name), 0) for name in entry['dirs'])
+        return sizes
+
+
+class AsyncFbxService:
+    """"Asynchronous service base class
+
+    Asynchronous services do not print anything: they return the result
+    part of the FreeboxOS responses, for use as a library.
+    """
+
+    def __init__(self, http, conf):
+        """Constructor"""
+        self._http = http
+        self._conf = conf
+
+    async def get_service_data(self, uri):
+        """Get service data"""
+        resp = await self._http.get(uri)
+        if not resp.success:
+            raise FbxException('Request failure: {}'.format(resp))
+
+        return resp
+
+    async def put_service_data(self, uri, data, timeout=None):
+        """Update service data"""
+        resp = await self._http.put(uri, data=data, timeout=timeout)
+        if not resp.success:
+            raise FbxException('Request failure: {}'.format(resp))
+
+        return resp
+
+
+class AsyncFbxServiceSystem(AsyncFbxService):
+    """System domain"""
+
+    async def reboot(self):
+        """ Reboot the freebox server now! """
+        log(">>> async reboot")
+        await self._http.post('/system/reboot/', timeout=3)
+        return True
+
+    async def get_system_info(self):
+        """Retrieve the system info"""
+        return (await self.get_service_data('/system')).result
+
+
+class AsyncFbxServiceConnection(AsyncFbxService):
+    """Connection domain"""
+
+    async def get_line_ethernet_info(self):
+        """Retrieve the connection status and rates"""
+        return (await self.get_service_data('/connection')).result
+
+    async def get_line_media_info(self):
+        """Retieve xDSL or FTTH info"""
+        conn = await self.get_line_ethernet_info()
+        uri = '/connection/ftth' if conn['media'] == 'ftth' else '/connection/xdsl'
+        return (await self.get_service_data(uri)).result
+
+
+class AsyncFbxServiceStorage(AsyncFbxService):
+    """Storage domain"""
+
+    async def get_connected_drives(self):
+        """Retrieve the drives, with their partitions"""
+        return (await self.get_service_data('/storage/disk/')).result
+
+
+class AsyncFbxServiceWifi(AsyncFbxService):
+    """Wifi domain"""
+
+    async def get_wifi_config(self):
+        """Get the current wifi config"""
+        return (await self.get_service_data('/wifi/config/')).result
+
+    async def get_wifi_radio_state(self):
+        """ Get the current status of wifi radio: True means ON """
+        return bool((await self.get_wifi_config()).get('enabled'))
+
+    async def set_wifi_radio_state(self, set_on):
+        """ Activate or deactivate wifi radio module """
+        log('>>> async set_wifi_radio_state {}'.format('ON' if set_on else 'OFF'))
+        import asyncio
+        try:
+            resp = await self.put_service_data(
+                '/wifi/config/', {'enabled': bool(set_on)}, timeout=3 if not set_on else None)
+        except asyncio.TimeoutError:
+            if not set_on:
+                # If we are connected using wifi, disabling wifi will close connection
+                # thus PUT response will never be received: a timeout is expected
+                return False
+            raise
+        return bool(resp.result.get('enabled'))
+
+    async def get_wifi_planning(self):
+        """ Get the current status of wifi planning: True means planning enabled """
+        return bool((await self.get_service_data('/wifi/planning/')).result.get('use_planning'))
+
+    async def set_wifi_planning(self, set_on):
+        """ Activate or deactivate wifi planning mode """
+        log('>>> async set_wifi_planning {}'.format('ON' if set_on else 'OFF'))
+        resp = await self.put_service_data('/wifi/planning/', {'use_planning': bool(set_on)})
+        return bool(resp.result.get('use_planning'))
+
+
+class AsyncFbxServiceDhcp(AsyncFbxService):
+    """DHCP domain"""
+
+    async def get_config(self):
+        """Get the current DHCP config"""
+        return (await self.get_service_data('/dhcp/config/')).result
+
+    async def get_dhcp_leases(self):
+        """ List the DHCP leases on going"""
+        return (await self.get_service_data('/dhcp/dynamic_lease/')).result or []
+
+
+class AsyncFbxServicePortForwarding(AsyncFbxService):
+    """Port Forwarding"""
+
+    async def get_port_forwardings(self):
+        """ List the port forwarding on going"""
+        return (await self.get_service_data('/fw/redir/')).result or []
+
+
+class AsyncFbxServiceCall(AsyncFbxService):
+    """Call domain"""
+
+    async def get_calls_list(self, new_only=False):
+        """ List the calls, or only the new ones """
+        calls = (await self.get_service_data('/call/log/')).result or []
+        if new_only:
+            calls = [call for call in calls if call.get('new') is not False]
+        return calls
+
+    async def mark_calls_as_read(self):
+        """ Mark all the calls as read """
+        log(">>> async mark_calls_as_read")
+        resp = await self._http.post('/call/log/mark_all_as_read/', {})
+        if not resp.success:
+            raise FbxException('Request failure: {}'.format(resp))
+        return True
+
+
+class AsyncFbxServiceDownload(AsyncFbxService):
+    """Download domain"""
+
+    async def get_downloads_list(self):
+        """ List downloads """
+        return (await self.get_service_data('/downloads/')).result or []
 
 
 class FreeboxOSCtrl:
@@ -1124,56 +3396,316 @@ class FreeboxOSCtrl:
     def __init__(self):
         """Constructor"""
         self._conf = FbxConfiguration(g_app_desc)
-        self._http = FbxHttp(self._conf)
-        self._srv_auth = FbxServiceAuth(self._http, self._conf)
-        self._srv_system = FbxServiceSystem(self._http, self._conf)
-        self._srv_connection = FbxServiceConnection(self._http, self._conf)
-        self._srv_storage = FbxServiceStorage(self._http, self._conf)
-        self._srv_download = FbxServiceDownload(self._http, self._conf)
-        self._srv_wifi = FbxServiceWifi(self._http, self._conf)
-        self._srv_dhcp = FbxServiceDhcp(self._http, self._conf)
-        self._srv_call = FbxServiceCall(self._http, self._conf)
-        self._srv_pfw = FbxServicePortForwarding(self._http, self._conf)
+        # transport and services are only built on first use
+        self._http = None
+        self._services = {}
+
+    def _service(self, cls):
+        """Return the service instance of the given class, building it if needed"""
+        srv = self._services.get(cls)
+        if srv is None:
+            srv = cls(self.http, self._conf)
+            self._services[cls] = srv
+        return srv
 
     @property
     def conf(self):
         return self._conf
 
+    @property
+    def http(self):
+        if self._http is None:
+            self._http = FbxHttp(self._conf)
+        return self._http
+
+    @property
+    def connection_stats(self):
+        if self._http is None:
+            return {'opened': 0, 'reused': 0, 'requests': 0}
+        return self._http.connection_stats
+
     @property
     def srv_auth(self):
-        return self._srv_auth
+        return self._service(FbxServiceAuth)
+
+    @property
+    def srv_system(self):
+        return self._service(FbxServiceSystem)
+
+    @property
+    def srv_connection(self):
+        return self._service(FbxServiceConnection)
+
+    @property
+    def srv_storage(self):
+        return self._service(FbxServiceStorage)
+
+    @property
+    def srv_download(self):
+        return self._service(FbxServiceDownload)
+
+    @property
+    def srv_wifi(self):
+        return self._service(FbxServiceWifi)
+
+    @property
+    def srv_dhcp(self):
+        return self._service(FbxServiceDhcp)
+
+    @property
+    def srv_call(self):
+        return self._service(FbxServiceCall)
+
+    @property
+    def srv_port(self):
+        return self._service(FbxServicePortForwarding)
+
+    @property
+    def srv_rrd(self):
+        return self._service(FbxServiceRrd)
+
+    @property
+    def srv_tsdb(self):
+        return self._service(FbxServiceTimeSeries)
+
+
+class AsyncFreeboxOSCtrl:
+    """Asynchronous controller, for use as a library from an asyncio event loop
+
+    Usage:
+        async with AsyncFreeboxOSCtrl(conf_path) as ctrl:
+            info, conn = await asyncio.gather(
+                ctrl.srv_system.get_system_info(),
+                ctrl.srv_connection.get_line_ethernet_info())
+    """
+
+    def __init__(self, conf_path='.'):
+        """Constructor"""
+        self._conf = FbxConfiguration(g_app_desc)
+        self._conf.conf_path = conf_path
+        self._conf.resp_as_json = True
+        self._http = AsyncFbxHttp(self._conf)
+        self._services = {}
+
+    async def __aenter__(self):
+        import asyncio
+        # mDNS discovery blocks: keep it off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self._conf.load_registered)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        """Close the connection pool"""
+        await self._http.close()
+
+    def _service(self, cls):
+        """Return the service instance of the given class, building it if needed"""
+        srv = self._services.get(cls)
+        if srv is None:
+            srv = cls(self._http, self._conf)
+            self._services[cls] = srv
+        return srv
+
+    @property
+    def conf(self):
+        return self._conf
+
+    @property
+    def http(self):
+        return self._http
 
     @property
     def srv_system(self):
-        return self._srv_system
+        return self._service(AsyncFbxServiceSystem)
 
     @property
     def srv_connection(self):
-        return self._srv_connection
+        return self._service(AsyncFbxServiceConnection)
 
     @property
     def srv_storage(self):
-        return self._srv_storage
+        return self._service(AsyncFbxServiceStorage)
 
     @property
     def srv_download(self):
-        return self._srv_download
+        return self._service(AsyncFbxServiceDownload)
 
     @property
     def srv_wifi(self):
-        return self._srv_wifi
+        return self._service(AsyncFbxServiceWifi)
 
     @property
     def srv_dhcp(self):
-        return self._srv_dhcp
+        return self._service(AsyncFbxServiceDhcp)
 
     @property
     def srv_call(self):
-        return self._srv_call
+        return self._service(AsyncFbxServiceCall)
 
     @property
     def srv_port(self):
-        return self._srv_pfw
+        return self._service(AsyncFbxServicePortForwarding)
+
+
+class FbxPrometheusExporter:
+    """Prometheus exporter of Freebox Server metrics
+
+    Metrics are built from the same endpoints as the display actions. Responses
+    are taken from the FbxHttp cache and concurrent scrapes wait for the request
+    in progress, so that several scrapers do not multiply the load on the box.
+    """
+
+    def __init__(self, ctrl):
+        """Constructor"""
+        self._ctrl = ctrl
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def _metric(self, lines, name, value, labels=None):
+        """Add a sample of the given metric to lines"""
+        if value is None:
+            return
+        sample = name
+        if labels:
+            sample += '{' + ','.join(
+                '{}="{}"'.format(k, FbxPrometheusExporter._escape(v)) for k, v in sorted(labels.items())) + '}'
+        lines.append((name, '{} {}'.format(sample, float(value))))
+
+    def _fetch(self, lines, uri):
+        """Return the result of uri, None (and the failure recorded) on error"""
+        try:
+            result = self._ctrl.srv_system.get_service_data(uri).result
+            self._metric(lines, 'freebox_scrape_success', 1, {'endpoint': uri})
+            return result
+        except Exception as exc:
+            log('Scrape of {} failed: {}'.format(uri, exc))
+            self._metric(lines, 'freebox_scrape_success', 0, {'endpoint': uri})
+            return None
+
+    def collect(self):
+        """Return the metrics in Prometheus text format"""
+        lines = []
+        self._collect_system(lines)
+        self._collect_connection(lines)
+        self._collect_storage(lines)
+        self._collect_downloads(lines)
+
+        # samples of a metric must be grouped, after its type
+        families = {}
+        for name, sample in lines:
+            families.setdefault(name, []).append(sample)
+        text = []
+        for name, samples in families.items():
+            text.append('# TYPE {} {}'.format(name, 'counter' if name.endswith('_total') else 'gauge'))
+            text.extend(samples)
+        return '\n'.join(text) + '\n'
+
+    def _collect_system(self, lines):
+        system = self._fetch(lines, '/system')
+        if system is None:
+            return
+        self._metric(lines, 'freebox_uptime_seconds', system.get('uptime_val'))
+        for sensor in system.get('sensors', []):
+            if sensor['id'].startswith('temp_'):
+                self._metric(lines, 'freebox_temperature_celsius', sensor.get('value'),
+                             {'id': sensor['id'], 'name': sensor.get('name')})
+            else:
+                self._metric(lines, 'freebox_sensor_value', sensor.get('value'),
+                             {'id': sensor['id'], 'name': sensor.get('name')})
+        for fan in system.get('fans', []):
+            self._metric(lines, 'freebox_fan_speed_rpm', fan.get('value'), {'id': fan['id'], 'name': fan.get('name')})
+        if 'fan_rpm' in system:
+            # older firmwares report a single fan
+            self._metric(lines, 'freebox_fan_speed_rpm', system['fan_rpm'], {'id': 'fan_rpm', 'name': 'fan'})
+
+    def _collect_connection(self, lines):
+        conn = self._fetch(lines, '/connection')
+        if conn is None:
+            return
+        self._metric(lines, 'freebox_connection_up', conn.get('state') == 'up', {'media': conn.get('media')})
+        for direction in ('down', 'up'):
+            labels = {'direction': direction}
+            self._metric(lines, 'freebox_connection_rate_bytes_per_second', conn.get('rate_' + direction), labels)
+            self._metric(
+                lines, 'freebox_connection_bandwidth_bits_per_second', conn.get('bandwidth_' + direction), labels)
+            self._metric(lines, 'freebox_connection_bytes_total', conn.get('bytes_' + direction), labels)
+
+        if conn.get('media') == 'ftth':
+            ftth = self._fetch(lines, '/connection/ftth')
+            if ftth is None:
+                return
+            self._metric(lines, 'freebox_ftth_link', ftth.get('link') is True)
+            if ftth.get('link') is True:
+                self._metric(lines, 'freebox_ftth_sfp_power_dbm', ftth.get('sfp_pwr_tx', 0) / 100, {'direction': 'tx'})
+                self._metric(lines, 'freebox_ftth_sfp_power_dbm', ftth.get('sfp_pwr_rx', 0) / 100, {'direction': 'rx'})
+        else:
+            xdsl = self._fetch(lines, '/connection/xdsl')
+            if xdsl is None:
+                return
+            for direction in ('down', 'up'):
+                stats = xdsl.get(direction, {})
+                labels = {'direction': direction}
+                self._metric(lines, 'freebox_xdsl_max_rate_bits_per_second', stats.get('rate', 0) * 1000, labels)
+                self._metric(lines, 'freebox_xdsl_attenuation_db', stats.get('attn_10', 0) / 10, labels)
+                self._metric(lines, 'freebox_xdsl_snr_db', stats.get('snr_10', 0) / 10, labels)
+
+    def _collect_storage(self, lines):
+        disks = self._fetch(lines, '/storage/disk/')
+        for drive in disks or []:
+            for part in drive.get('partitions', []):
+                labels = {'disk': drive.get('model') or '_no_brand_', 'partition': part.get('label')}
+                self._metric(lines, 'freebox_partition_total_bytes', part.get('total_bytes'), labels)
+                self._metric(lines, 'freebox_partition_used_bytes', part.get('used_bytes'), labels)
+                self._metric(lines, 'freebox_partition_free_bytes', part.get('free_bytes'), labels)
+
+    def _collect_downloads(self, lines):
+        dls = self._fetch(lines, '/downloads/')
+        counts = {}
+        for dl in dls or []:
+            # missing labels are exported empty, as None does not sort with strings
+            key = (dl.get('type') or '', dl.get('status') or '')
+            counts[key] = counts.get(key, 0) + 1
+        for (dl_type, status), count in sorted(counts.items()):
+            self._metric(lines, 'freebox_downloads', count, {'type': dl_type, 'status': status})
+
+    def serve(self, address):
+        """Serve metrics over HTTP on the given [host:]port until interrupted"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        host, _, port = address.rpartition(':')
+        exporter = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            """ Serve /metrics """
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = exporter.collect().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                log(fmt % args)
+
+        server = ThreadingHTTPServer((host, int(port)), RequestHandler)
+        print('Serving metrics on http://{}:{}/metrics'.format(host or '0.0.0.0', port))
+        sys.stdout.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return RC_OK
 
 
 class FreeboxOSCli:
@@ -1198,14 +3730,65 @@ class FreeboxOSCli:
             '-j',
             action='store_true',
             help='simply print Freebox Server reponse in JSON format')
+        self._parser.add_argument(
+            '--ndjson',
+            action='store_true',
+            help='print results in JSON format, one line per item for lists (calls, leases, downloads,' +
+            ' port forwardings), items being output as they are received')
+        self._parser.add_argument(
+            '--csv',
+            action='store_true',
+            help='print results in CSV format, one row per item for lists, nested fields being' +
+            ' columns named "a.b"')
+        self._parser.add_argument(
+            '--fields',
+            metavar='FIELD,...',
+            help='with -j, --ndjson or --csv, only output the given fields of results (or of their' +
+            ' items), nested fields being given as "a.b"')
         self._parser.add_argument(
             '-c',
             nargs=1,
             dest='conf_path',
             default='.',
             help='path where to store/retrieve this app configuration files (default: local directory)')
-        # Real freeboxOS actions
-        group = self._parser.add_mutually_exclusive_group(required=True)
+        self._parser.add_argument(
+            '--daemon',
+            action='store_true',
+            help='run as a daemon serving actions of other fbxosctrl invocations over a unix socket')
+        self._parser.add_argument(
+            '--socket',
+            help='unix socket of the daemon (default: fbxosctrl.sock in configuration directory).' +
+            ' When the daemon is running, actions are forwarded to it')
+        self._parser.add_argument(
+            '--ca-file',
+            metavar='FILE',
+            help='CA certificates file trusted instead of the Freebox root certificates, e.g. to' +
+            ' reach a test server (default: FBXOSCTRL_CA_FILE environment variable)')
+        self._parser.add_argument(
+            '--max-age',
+            type=float,
+            metavar='SECONDS',
+            help='accept responses up to SECONDS old from the on-disk cache of the configuration directory' +
+            ' (and store fresh ones in it)')
+        self._parser.add_argument(
+            '--watch',
+            type=float,
+            metavar='INTERVAL',
+            help='sample the given actions every INTERVAL seconds, printing each sample as a JSON line' +
+            ' (only lease changes for --dhcpleases).' +
+            ' Supported actions: {}'.format(', '.join('--' + cmd for cmd in FreeboxOSCli.WATCH_URIS)))
+        self._parser.add_argument(
+            '--exporter',
+            metavar='[HOST:]PORT',
+            help='run as a Prometheus exporter serving Freebox Server metrics on http://HOST:PORT/metrics')
+        self._parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help='max number of read-only actions run concurrently (default: 4)')
+        # Real freeboxOS actions: several ones can be given at once
+        group = self._parser.add_argument_group(
+            'actions', 'one or several actions, executed in the given order over a single session')
         group.add_argument(
             '--regapp',
             default=argparse.SUPPRESS,
@@ -1247,6 +3830,12 @@ class FreeboxOSCli:
             default=argparse.SUPPRESS,
             action='store_true',
             help='display the current DHCP leases info')
+        group.add_argument(
+            '--lease-find',
+            default=argparse.SUPPRESS,
+            nargs='+',
+            metavar='MAC|IP|HOSTNAME',
+            help='display the DHCP leases matching the given MAC addresses, IP addresses or hostnames')
         group.add_argument(
             '--pfwd',
             default=argparse.SUPPRESS,
@@ -1267,6 +3856,17 @@ class FreeboxOSCli:
             default=argparse.SUPPRESS,
             action='store_true',
             help='set read status for all received calls')
+        group.add_argument(
+            '--csync',
+            default=argparse.SUPPRESS,
+            action='store_true',
+            help='store the calls received since last sync into the local call log')
+        group.add_argument(
+            '--clog',
+            default=argparse.SUPPRESS,
+            action='store_true',
+            help='display the calls of the local call log matching --since/--number/--type,' +
+            ' without any request to the Freebox Server')
         group.add_argument(
             '--reboot',
             default=argparse.SUPPRESS,
@@ -1297,40 +3897,236 @@ class FreeboxOSCli:
             default=argparse.SUPPRESS,
             action='store_true',
             help='display spaces (total/used/free) on connected drives')
+        group.add_argument(
+            '--du',
+            default=argparse.SUPPRESS,
+            metavar='PATH',
+            help='display the size of PATH (e.g. "/Disque dur") and of its subdirectories on Freebox Server' +
+            ' storage. Only directories modified since previous run are listed again, unless --du-full is given')
+        self._parser.add_argument(
+            '--du-full',
+            action='store_true',
+            help='with --du, list all directories again instead of using the local index')
+        group.add_argument(
+            '--fetch',
+            default=argparse.SUPPRESS,
+            nargs=2,
+            metavar=('REMOTE', 'LOCAL'),
+            help='download the file REMOTE (e.g. "/Disque dur/file.mkv") of Freebox Server storage into LOCAL,' +
+            ' resuming a previous partial download')
+        self._parser.add_argument(
+            '--segments',
+            type=int,
+            default=1,
+            metavar='N',
+            help='with --fetch, download large files as N segments over concurrent connections (max: 8)')
         group.add_argument(
             '--tlist',  # 't' stands for 'téléchargement'
             default=argparse.SUPPRESS,
             action='store_true',
             help='display downloads list')
-
-        # Configure cmd=>callback association
+        group.add_argument(
+            '--tadd',
+            default=argparse.SUPPRESS,
+            metavar='FILE',
+            help='add downloads of the URLs or magnet links read from FILE ("-" for stdin), one per line')
+        group.add_argument(
+            '--rrd',
+            default=argparse.SUPPRESS,
+            choices=FbxServiceRrd.DATABASES,
+            help='export history of the given RRD database as CSV, or JSON with -j/--ndjson (see --rrd-* options)')
+        group.add_argument(
+            '--tsdb-record',
+            default=argparse.SUPPRESS,
+            action='store_true',
+            help='record connection, system and storage metrics into the local time-series store')
+        group.add_argument(
+            '--tsdb-query',
+            default=argparse.SUPPRESS,
+            metavar='PATTERN',
+            help='display min/max/avg of the stored metrics matching PATTERN (e.g. "system.*")' +
+            ' over --tsdb-period, without any request to the Freebox Server')
+        self._parser.add_argument(
+            '--tsdb-period',
+            type=int,
+            default=86400,
+            metavar='SECONDS',
+            help='period queried by --tsdb-query, up to now (default: 86400)')
+        self._parser.add_argument(
+            '--record',
+            action='store_true',
+            help='with --watch, also record samples into the local time-series store')
+        calls = self._parser.add_argument_group('call log options')
+        calls.add_argument(
+            '--since',
+            metavar='DATE',
+            help='calls since DATE (YYYY-MM-DD or "YYYY-MM-DD HH:MM[:SS]")')
+        calls.add_argument(
+            '--number',
+            help='calls from/to NUMBER')
+        calls.add_argument(
+            '--type',
+            choices=('missed', 'accepted', 'outgoing'),
+            help='calls of the given type')
+        downloads = self._parser.add_argument_group('downloads options')
+        downloads.add_argument(
+            '--status',
+            choices=FbxServiceDownload.STATUSES,
+            help='downloads with the given status only')
+        downloads.add_argument(
+            '--offset',
+            type=int,
+            metavar='N',
+            help='skip the N first downloads')
+        downloads.add_argument(
+            '--limit',
+            type=int,
+            metavar='N',
+            help='display N downloads at most')
+        downloads.add_argument(
+            '--rate',
+            type=float,
+            metavar='N',
+            help='with --tadd, submit N downloads per second at most')
+        rrd = self._parser.add_argument_group('RRD export options')
+        rrd.add_argument(
+            '--rrd-period',
+            type=int,
+            default=86400,
+            metavar='SECONDS',
+            help='period to export, up to now (default: 86400)')
+        rrd.add_argument(
+            '--rrd-step',
+            type=int,
+            metavar='SECONDS',
+            help='downsample history to one averaged sample every SECONDS')
+        rrd.add_argument(
+            '--rrd-fields',
+            metavar='FIELD,...',
+            help='fields to export (default: all fields of the database)')
+        rrd.add_argument(
+            '--rrd-out',
+            metavar='FILE',
+            help='write to FILE instead of stdout, in Parquet format if FILE ends with .parquet')
+
+        # Configure cmd=>callback association: callbacks are given as
+        # (controller service, method) so that services are built on demand
         self._cmd_handlers = {
-            'regapp': self._ctrl.srv_auth.register_app,
-            'wrstatus': self._ctrl.srv_wifi.get_wifi_radio_state,
-            'wron': self._ctrl.srv_wifi.set_wifi_radio_on,
-            'wroff': self._ctrl.srv_wifi.set_wifi_radio_off,
-            'wpstatus': self._ctrl.srv_wifi.get_wifi_planning,
-            'wpon': self._ctrl.srv_wifi.set_wifi_planning_on,
-            'wpoff': self._ctrl.srv_wifi.set_wifi_planning_off,
-            'dhcpleases': self._ctrl.srv_dhcp.get_dhcp_leases,
-            'pfwd': self._ctrl.srv_port.get_port_forwardings,
-            'clist': self._ctrl.srv_call.get_all_calls_list,
-            'cnew': self._ctrl.srv_call.get_new_calls_list,
-            'cread': self._ctrl.srv_call.mark_calls_as_read,
-            'reboot': self._ctrl.srv_system.reboot,
-            'sinfo': self._ctrl.srv_system.get_system_info,
-            'einfo': self._ctrl.srv_connection.get_line_ethernet_info,
-            'linfo': self._ctrl.srv_connection.get_line_media_info,
-            'dlist': self._ctrl.srv_storage.get_connected_drives,
-            'dspace': self._ctrl.srv_storage.get_storage_status,
-            'tlist': self._ctrl.srv_download.get_downloads_list,
+            'regapp': ('srv_auth', 'register_app'),
+            'wrstatus': ('srv_wifi', 'get_wifi_radio_state'),
+            'wron': ('srv_wifi', 'set_wifi_radio_on'),
+            'wroff': ('srv_wifi', 'set_wifi_radio_off'),
+            'wpstatus': ('srv_wifi', 'get_wifi_planning'),
+            'wpon': ('srv_wifi', 'set_wifi_planning_on'),
+            'wpoff': ('srv_wifi', 'set_wifi_planning_off'),
+            'dhcpleases': ('srv_dhcp', 'get_dhcp_leases'),
+            'lease_find': ('srv_dhcp', 'find_leases'),
+            'pfwd': ('srv_port', 'get_port_forwardings'),
+            'clist': ('srv_call', 'get_all_calls_list'),
+            'cnew': ('srv_call', 'get_new_calls_list'),
+            'cread': ('srv_call', 'mark_calls_as_read'),
+            'csync': ('srv_call', 'sync_calls'),
+            'clog': ('srv_call', 'query_calls'),
+            'reboot': ('srv_system', 'reboot'),
+            'sinfo': ('srv_system', 'get_system_info'),
+            'einfo': ('srv_connection', 'get_line_ethernet_info'),
+            'linfo': ('srv_connection', 'get_line_media_info'),
+            'dlist': ('srv_storage', 'get_connected_drives'),
+            'dspace': ('srv_storage', 'get_storage_status'),
+            'du': ('srv_storage', 'get_disk_usage'),
+            'fetch': ('srv_storage', 'fetch_file'),
+            'tlist': ('srv_download', 'get_downloads_list'),
+            'tadd': ('srv_download', 'add_downloads'),
+            'rrd': ('srv_rrd', 'export_rrd'),
+            'tsdb_record': ('srv_tsdb', 'record'),
+            'tsdb_query': ('srv_tsdb', 'query'),
         }
+        # cmd => options of its callback, set when parsing args
+        self._cmd_options = {}
+        # actions given, and fields to output in JSON mode (as lists of keys)
+        self._actions = []
+        self._fields = None
+        self._csv = False
+
+    def _handler(self, cmd, value=True):
+        """Return the callback associated to cmd, or help display if unknown
+
+        The callback is bound to the options of the action and, for actions
+        taking a value, to this value.
+        """
+        if cmd not in self._cmd_handlers:
+            return self._parser.print_help
+        srv, method = self._cmd_handlers[cmd]
+        callback = getattr(getattr(self._ctrl, srv), method)
+        if value is True:
+            return functools.partial(callback, **self._cmd_options.get(cmd, {}))
+        return functools.partial(callback, value, **self._cmd_options.get(cmd, {}))
+
+    # actions which do not modify anything on Freebox Server and so can be run concurrently
+    READ_ONLY_CMDS = (
+        'wrstatus', 'wpstatus', 'dhcpleases', 'lease_find', 'pfwd', 'clist', 'cnew',
+        'sinfo', 'einfo', 'linfo', 'dlist', 'dspace', 'tlist')
+
+    # actions which do not need the Freebox Server at all
+    OFFLINE_CMDS = ('tsdb_query', 'clog')
+
+    # actions which can be sampled with --watch, and the endpoint sampled
+    WATCH_URIS = {
+        'einfo': '/connection',
+        'sinfo': '/system',
+        'tlist': '/downloads/',
+        'dhcpleases': '/dhcp/dynamic_lease/',
+    }
 
     def parse_args(self, argv):
         """ Parse the parameters and execute the associated command """
         args = self._parser.parse_args(argv)
         argsdict = vars(args)
 
+        self._workers = max(1, argsdict.pop('workers'))
+        self._daemon = argsdict.pop('daemon')
+        self._ctrl.conf.max_age = argsdict.pop('max_age')
+        self._watch = argsdict.pop('watch')
+        self._exporter = argsdict.pop('exporter')
+        self._record = argsdict.pop('record')
+        self._cmd_options['tsdb_query'] = {'period': argsdict.pop('tsdb_period')}
+        rrd_fields = argsdict.pop('rrd_fields')
+        self._cmd_options['rrd'] = {
+            'period': argsdict.pop('rrd_period'),
+            'step': argsdict.pop('rrd_step'),
+            'out': argsdict.pop('rrd_out'),
+            'fields': rrd_fields.split(',') if rrd_fields else None}
+        since = argsdict.pop('since')
+        if since is not None:
+            try:
+                since = int(datetime.fromisoformat(since).timestamp())
+            except ValueError:
+                self._parser.error('invalid --since date: {}'.format(since))
+        self._cmd_options['clog'] = {
+            'since': since,
+            'number': argsdict.pop('number'),
+            'call_type': argsdict.pop('type')}
+        self._cmd_options['tlist'] = {
+            'status': argsdict.pop('status'),
+            'offset': argsdict.pop('offset'),
+            'limit': argsdict.pop('limit')}
+        if any(value is not None and value < 0 for value in (self._cmd_options['tlist']['offset'],
+                                                             self._cmd_options['tlist']['limit'])):
+            self._parser.error('--offset and --limit must not be negative')
+        rate = argsdict.pop('rate')
+        if rate is not None and rate <= 0:
+            self._parser.error('--rate must be positive')
+        self._cmd_options['tadd'] = {'workers': self._workers, 'rate': rate}
+        self._cmd_options['du'] = {'workers': self._workers, 'full': argsdict.pop('du_full')}
+        segments = argsdict.pop('segments')
+        if not 1 <= segments <= 8:
+            self._parser.error('--segments must be between 1 and 8')
+        self._cmd_options['fetch'] = {'segments': segments}
+        socket_file = argsdict.pop('socket')
+        ca_file = argsdict.pop('ca_file')
+        if ca_file is not None:
+            self._ctrl.conf.ca_file = ca_file
+
         # Activate verbose mode if requested
         if argsdict.get('v'):
             enable_log(True)
@@ -1340,6 +4136,18 @@ class FreeboxOSCli:
         if argsdict.get('j'):
             self._ctrl.conf.resp_as_json = True
         del argsdict['j']
+        if argsdict.pop('ndjson'):
+            self._ctrl.conf.resp_as_json = True
+            self._ctrl.conf.resp_as_ndjson = True
+        # CSV rows are output from the same items as JSON lines
+        self._csv = argsdict.pop('csv')
+        if self._csv:
+            self._ctrl.conf.resp_as_json = True
+            self._ctrl.conf.resp_as_ndjson = True
+        fields = argsdict.pop('fields')
+        self._fields = [field.split('.') for field in fields.split(',')] if fields else None
+        if self._fields and not self._ctrl.conf.resp_as_json:
+            self._parser.error('--fields requires -j, --ndjson or --csv')
 
         # Set configuration path (local directory by default)
         conf_path = argsdict.get('conf_path')[0]
@@ -1348,15 +4156,381 @@ class FreeboxOSCli:
             sys.exit(1)
         self._ctrl.conf.conf_path = conf_path
         del argsdict['conf_path']
+        if socket_file is not None:
+            self._ctrl.conf.socket_file = socket_file
+        self._actions = list(argsdict)
+
+        if not argsdict and not self._daemon and not self.is_exporter:
+            self._parser.error('at least one action is required')
+        if self._watch is not None:
+            if self._watch <= 0:
+                self._parser.error('watch interval must be positive')
+            unsupported = [cmd for cmd in argsdict if cmd not in FreeboxOSCli.WATCH_URIS]
+            if unsupported:
+                self._parser.error('actions not supported in watch mode: {}'.format(
+                    ', '.join('--' + cmd for cmd in unsupported)))
+            # samples are always printed in JSON format
+            self._ctrl.conf.resp_as_json = True
 
         return argsdict
 
     def dispatch(self, args):
-        """ Call controller action """
-        for cmd in args:
+        """ Call controller actions
+
+        With a single action, its result is returned. With several actions, they
+        are executed in the given order, consecutive read-only ones being run
+        concurrently, and outputs are printed in the given order. The result is
+        then a dict of results by action in JSON mode, else the last result.
+        """
+        cmds = list(args)
+        if len(cmds) == 1:
             # retrieve callback associated to cmd and execute it, if not found
             # display help
-            return self._cmd_handlers.get(cmd, self._parser.print_help)()
+            return self._handler(cmds[0], args[cmds[0]])()
+
+        results = {}
+        batch = {}
+        for cmd in cmds:
+            if cmd in FreeboxOSCli.READ_ONLY_CMDS:
+                batch[cmd] = args[cmd]
+                continue
+            results.update(self._run_concurrently(batch))
+            batch = {}
+            results[cmd] = self._handler(cmd, args[cmd])()
+        results.update(self._run_concurrently(batch))
+
+        if self._ctrl.conf.resp_as_json:
+            return results
+        return results[cmds[-1]]
+
+    def output(self, rc):
+        """ Print JSON results on stdout, return the exit code
+
+        In JSON lines mode, a line is printed per item of list results, as
+        soon as it is available. With several actions, each line is then
+        tagged with its action. In CSV mode, a row is printed per item the
+        same way, the rows of each action following their own header.
+        """
+        conf = self._ctrl.conf
+        if not conf.resp_as_json or rc is None or isinstance(rc, (bool, int)):
+            return rc
+
+        if not conf.resp_as_ndjson:
+            json.dump(self._project(rc), sys.stdout, default=str)
+            sys.stdout.write('\n')
+            return RC_OK
+
+        results = rc.items() if len(self._actions) > 1 and isinstance(rc, dict) else [(None, rc)]
+        try:
+            for cmd, result in results:
+                if self._csv:
+                    self._output_csv(cmd, FreeboxOSCli._items(result))
+                    continue
+                for item in FreeboxOSCli._items(result):
+                    item = self._project_item(item)
+                    if cmd is not None:
+                        item = {'action': cmd, 'item': item}
+                    sys.stdout.write(json.dumps(item, default=str) + '\n')
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # reader is gone (as with | head): stop there, silently
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return RC_OK
+
+    def _output_csv(self, cmd, items):
+        """ Print items as CSV rows, after a header of --fields, else of the first item fields """
+        import csv
+        writer = csv.writer(sys.stdout, lineterminator='\n')
+        tag = [cmd] if cmd is not None else []
+        columns = None
+        for item in items:
+            row = FreeboxOSCli._flatten(self._project_item(item))
+            if columns is None:
+                columns = ['.'.join(keys) for keys in self._fields] if self._fields else list(row)
+                writer.writerow((['action'] if tag else []) + columns)
+            writer.writerow(tag + [row.get(column, '') for column in columns])
+
+    @staticmethod
+    def _flatten(item, prefix=''):
+        """ Return {column: value} of an item, nested fields being named "a.b" """
+        if not isinstance(item, dict):
+            return {prefix or 'value': item}
+        row = {}
+        for key, value in item.items():
+            column = prefix + key
+            if isinstance(value, dict):
+                row.update(FreeboxOSCli._flatten(value, column + '.'))
+            elif isinstance(value, list):
+                row[column] = json.dumps(value, default=str)
+            else:
+                row[column] = '' if value is None else value
+        return row
+
+    @staticmethod
+    def _items(result):
+        """ Return the items of a result: these of its list, else the result itself """
+        if isinstance(result, dict) and set(result) >= {'success', 'result'}:
+            result = result['result']
+        if result is None:
+            return []
+        if isinstance(result, (dict, str, int, float)):
+            return [result]
+        return result
+
+    def _project(self, rc):
+        """ Return JSON results reduced to --fields """
+        if not self._fields:
+            return rc
+        if len(self._actions) > 1 and isinstance(rc, dict):
+            return {cmd: self._project_result(result) for cmd, result in rc.items()}
+        return self._project_result(rc)
+
+    def _project_result(self, result):
+        """ Reduce a result (or the items of its list) to --fields """
+        if isinstance(result, dict) and set(result) >= {'success', 'result'}:
+            return dict(result, result=self._project_result(result['result']))
+        if isinstance(result, list):
+            return [self._project_item(item) for item in result]
+        return self._project_item(result)
+
+    def _project_item(self, item):
+        """ Return item reduced to --fields, dotted fields selecting nested values """
+        if not self._fields or not isinstance(item, dict):
+            return item
+        projected = {}
+        for keys in self._fields:
+            value = item
+            for key in keys:
+                if not isinstance(value, dict) or key not in value:
+                    break
+                value = value[key]
+            else:
+                target = projected
+                for key in keys[:-1]:
+                    target = target.setdefault(key, {})
+                target[keys[-1]] = value
+        return projected
+
+    @property
+    def is_daemon(self):
+        return self._daemon
+
+    def needs_box(self, args):
+        """ Tell whether Freebox Server addressing/registration is required """
+        if self._daemon or self.is_exporter:
+            return True
+        return any(cmd not in FreeboxOSCli.OFFLINE_CMDS for cmd in args)
+
+    @property
+    def is_watch(self):
+        return self._watch is not None
+
+    @property
+    def is_exporter(self):
+        return self._exporter is not None
+
+    def export(self):
+        """ Serve Prometheus metrics until interrupted """
+        return FbxPrometheusExporter(self._ctrl).serve(self._exporter)
+
+    def watch(self, args):
+        """ Sample actions periodically, printing one JSON line per action and sample
+
+        Samples are scheduled on a fixed time grid: a late sample does not shift
+        next ones, and samples which could not be taken in time are skipped.
+        """
+        interval = self._watch
+        recorder = self._ctrl.srv_tsdb if self._record else None
+        lease_changes = FbxLeaseChanges()
+        start = time.monotonic()
+        tick = 0
+        try:
+            while True:
+                for cmd in args:
+                    for record in self._sample(cmd, recorder, lease_changes):
+                        sys.stdout.write(json.dumps(record) + '\n')
+                sys.stdout.flush()
+
+                tick += 1
+                now = time.monotonic()
+                if start + tick * interval < now:
+                    # too late for next sample(s): skip them
+                    tick = int((now - start) // interval) + 1
+                time.sleep(start + tick * interval - now)
+        except (KeyboardInterrupt, BrokenPipeError):
+            pass
+        return RC_OK
+
+    def _sample(self, cmd, recorder, lease_changes):
+        """ Sample an action, return the records to print
+
+        For leases, a record is returned per change since previous sample.
+        """
+        uri = FreeboxOSCli.WATCH_URIS[cmd]
+        record = {'time': time.time(), 'action': cmd}
+        try:
+            result = self._ctrl.srv_system.get_service_data(uri, cached=False).result
+            if recorder is not None:
+                recorder.record_result(uri, result, record['time'])
+        except FbxException as exc:
+            record['error'] = str(exc)
+            return [record]
+
+        if cmd == 'dhcpleases':
+            return [dict(record, **event) for event in lease_changes.update(result or [])]
+        record['result'] = result
+        return [record]
+
+    def forward(self, args):
+        """ Forward actions to the daemon if it is running
+
+        Return a (forwarded, result) tuple, forwarded being False when actions
+        have to be executed locally.
+        """
+        if self._daemon or self.is_watch or self.is_exporter or not args or 'regapp' in args or g_log_enabled:
+            return False, None
+        if any(value is not None for cmd in args for value in self._cmd_options.get(cmd, {}).values()):
+            # actions with options are executed locally
+            return False, None
+
+        import socket
+        socket_file = self._ctrl.conf.socket_file
+        if not os.path.exists(socket_file):
+            return False, None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_file)
+        except OSError:
+            # stale socket file: daemon is not running anymore
+            sock.close()
+            return False, None
+
+        with sock, sock.makefile('rwb') as stream:
+            req = {
+                'actions': args,
+                'json': self._ctrl.conf.resp_as_json,
+                'max_age': self._ctrl.conf.max_age}
+            stream.write(json.dumps(req).encode() + b'\n')
+            stream.flush()
+            sock.shutdown(socket.SHUT_WR)
+            reply = stream.readline()
+        if not reply:
+            raise FbxException('No reply from daemon on {}'.format(socket_file))
+        reply = json.loads(reply.decode())
+        sys.stdout.write(reply.get('output', ''))
+        if reply.get('error') is not None:
+            raise FbxException('Daemon failure: {}'.format(reply['error']))
+        return True, reply.get('rc')
+
+    def serve(self):
+        """ Serve actions forwarded by other invocations until terminated """
+        import signal
+        import socket
+        import socketserver
+
+        cli = self
+        conf = self._ctrl.conf
+        capture = FbxOutputCapture(sys.stdout)
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            """ Execute actions of a single request, capturing their output """
+
+            def handle(self):
+                reply = {}
+                capture.start()
+                try:
+                    req = json.loads(self.rfile.readline().decode())
+                    log('Daemon request: {}'.format(req))
+                    conf.resp_as_json = bool(req.get('json'))
+                    # lists are sent back whole to the client
+                    conf.resp_as_ndjson = False
+                    conf.max_age = req.get('max_age')
+                    actions = {cmd: value for cmd, value in req.get('actions', {}).items() if cmd in cli._cmd_handlers}
+                    if not actions or 'regapp' in actions:
+                        raise FbxException('Invalid actions: {}'.format(req.get('actions')))
+                    reply['rc'] = cli.dispatch(actions)
+                except Exception as exc:
+                    reply['error'] = str(exc)
+                finally:
+                    reply['output'] = capture.stop()
+                self.wfile.write(json.dumps(reply, default=str).encode() + b'\n')
+
+        socket_file = conf.socket_file
+        if os.path.exists(socket_file):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_file)
+                raise FbxException('A daemon is already running on {}'.format(socket_file))
+            except OSError:
+                # stale socket file
+                os.remove(socket_file)
+            finally:
+                probe.close()
+
+        # requests are served one at a time as they share the output format setting,
+        # read-only actions of a request still being run concurrently
+        umask = os.umask(0o077)
+        try:
+            server = socketserver.UnixStreamServer(socket_file, RequestHandler)
+        finally:
+            os.umask(umask)
+
+        def terminate(signum, frame):
+            sys.exit(0)
+        signal.signal(signal.SIGTERM, terminate)
+
+        print('Serving on {}'.format(socket_file))
+        sys.stdout.flush()
+        sys.stdout = capture
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sys.stdout = capture.stream
+            server.server_close()
+            os.remove(socket_file)
+        return RC_OK
+
+    def _run_concurrently(self, actions):
+        """ Run read-only actions (cmd => value) on a thread pool, printing outputs in order
+
+        Results streamed in JSON lines mode are gathered by the pool, for their
+        requests to be sent concurrently too.
+        """
+        if len(actions) < 2 or self._workers < 2:
+            return {cmd: self._handler(cmd, value)() for cmd, value in actions.items()}
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        capture = FbxOutputCapture(sys.stdout)
+
+        def run(cmd):
+            capture.start()
+            try:
+                rc = self._handler(cmd, actions[cmd])()
+                # items streamed in JSON lines mode are received here, else
+                # their requests would only be sent one after the other on output
+                if hasattr(rc, '__next__'):
+                    rc = list(rc)
+                return rc, None, capture.stop()
+            except Exception as exc:
+                return None, exc, capture.stop()
+
+        results = {}
+        sys.stdout = capture
+        try:
+            with ThreadPoolExecutor(max_workers=min(self._workers, len(actions))) as pool:
+                futures = [(cmd, pool.submit(run, cmd)) for cmd in actions]
+                for cmd, future in futures:
+                    rc, exc, output = future.result()
+                    capture.stream.write(output)
+                    if exc is not None:
+                        raise exc
+                    results[cmd] = rc
+        finally:
+            sys.stdout = capture.stream
+        return results
 
 
 if __name__ == '__main__':
@@ -1365,9 +4539,21 @@ if __name__ == '__main__':
 
         args = cli.parse_args(sys.argv[1:])
 
-        want_regapp = True if 'regapp' in args else False
-        ctrl.conf.load(want_regapp)
-
-        rc = cli.dispatch(args)
+        forwarded, rc = cli.forward(args)
+        if not forwarded:
+            if cli.needs_box(args):
+                want_regapp = True if 'regapp' in args else False
+                ctrl.conf.load(want_regapp)
+
+            if cli.is_daemon:
+                rc = cli.serve()
+            elif cli.is_exporter:
+                rc = cli.export()
+            elif cli.is_watch:
+                rc = cli.watch(args)
+            else:
+                rc = cli.dispatch(args)
+        rc = cli.output(rc)
+        log('Connections: {}'.format(ctrl.connection_stats))
 
         sys.exit(rc)